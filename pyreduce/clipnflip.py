@@ -55,14 +55,9 @@ def clipnflip(image, header, xrange=None, yrange=None, orientation=None):
         # Make sure trim region is a subset of actual image.
         sz = image.shape
         if (
-            np.any(xlo < 0)
-            | np.any(xlo >= sz[1])
-            | np.any(ylo < 0)
-            | np.any(ylo >= sz[0])
-            | np.any(xhi < 0)
-            | np.any(xhi > sz[1])
-            | np.any(yhi < 0)
-            | np.any(yhi > sz[0])
+            min(xlo.min(), xhi.min(), ylo.min(), yhi.min()) < 0
+            or max(xlo.max() + 1, xhi.max()) > sz[1]
+            or max(ylo.max() + 1, yhi.max()) > sz[0]
         ):
             raise ValueError("Error specifying trim region")
 
@@ -126,6 +121,8 @@ def clipnflip(image, header, xrange=None, yrange=None, orientation=None):
 
     # Flip image (if necessary) to achieve standard image orientation.
     orientation = orientation if orientation is not None else header.get("e_orient")
-    if orientation is not None:
+    # np.rot90 only returns a view, so no data is copied here
+    # Use np.ascontiguousarray if the memory layout matters later
+    if orientation is not None and orientation % 4 != 0:
         timage = np.rot90(timage, -1 * orientation)
     return timage
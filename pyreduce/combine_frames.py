@@ -7,56 +7,114 @@ Used to create master bias and master flat
 import datetime
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import astropy.io.fits as fits
 import matplotlib.pyplot as plt
 import numpy as np
 from dateutil import parser
-from scipy.ndimage.filters import median_filter
+from scipy.ndimage.filters import median_filter, uniform_filter1d
 
 from .clipnflip import clipnflip
 from .instruments.instrument_info import get_instrument_info
 from .util import gaussbroad, gaussfit, load_fits
 
+# Maximum number of threads used to read files in parallel
+MAX_IO_THREADS = 8
+# Number of rows of each amplifier that are combined together
+ROW_BLOCK_SIZE = 256
+# Maximum number of row blocks that are combined at the same time
+MAX_BLOCK_THREADS = 4
+
+
+# Datatype of the raw data in a fits file, for a given BITPIX
+BITPIX_DTYPE = {8: "u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+
+def open_memmap(fname, extension):
+    """
+    Memory map the raw (unscaled) image data of a fits file
+
+    The data is mapped directly with np.memmap, which avoids the overhead
+    of accessing the data through the astropy HDU for each read.
+    Compressed files can not be memory mapped and are read into memory instead.
+
+    Parameters
+    ----------
+    fname : str
+        filename
+    extension : int
+        fits extension to load
+
+    Returns
+    -------
+    data : array
+        raw image data, without bscale or bzero applied
+    """
+    with fits.open(fname, memmap=True, do_not_scale_image_data=True) as hdulist:
+        hdu = hdulist[extension]
+        info = hdu.fileinfo()
+        compressed = info["file"].compression is not None
+        if compressed or isinstance(hdu, fits.CompImageHDU):
+            return np.array(hdu.data)
+
+        header = hdu.header
+        dtype = BITPIX_DTYPE[header["BITPIX"]]
+        shape = tuple(header["NAXIS%i" % i] for i in range(header["NAXIS"], 0, -1))
+
+    return np.memmap(fname, dtype=dtype, mode="r", offset=info["datLoc"], shape=shape)
+
 
 def running_median(arr, size):
     """Calculate the running median of a 2D sequence
 
+    The median is taken along the last axis, i.e. along each row
+
     Parameters
     ----------
-    seq : 2d array [n, l]
-        n datasets of length l
+    seq : array[..., l]
+        datasets of length l
     size : int
         number of elements to consider for each median
     Returns
     -------
-    2d array [n, l-size]
+    array[..., l-size]
         running median
     """
 
-    ret = np.array([median_filter(s, size=size, mode="constant") for s in arr])
+    # Filter all rows in a single call, with a window of size 1 in every other axis
+    footprint = (1,) * (arr.ndim - 1) + (size,)
+    ret = median_filter(arr, size=footprint, mode="constant")
     m = size // 2
-    return ret[:, m:-m]
+    return ret[..., m:-m]
 
 
 def running_sum(arr, size):
     """Calculate the running sum over the 2D sequence
 
+    The sum is taken along the last axis, i.e. along each row
+
     Parameters
     ----------
-    arr : array[n, l]
-        sequence to calculate running sum over, n datasets of length l
+    arr : array[..., l]
+        sequence to calculate running sum over, datasets of length l
     size : int
         number of elements to sum
     Returns
     -------
-    2D array
+    array[..., l-size+1]
         running sum
     """
 
-    ret = np.cumsum(arr, axis=1)
-    ret[:, size:] -= ret[:, :-size]
-    return ret[:, size - 1 :]
+    # uniform_filter1d calculates the running mean in a single pass
+    # and avoids the loss of precision of the cumulative sum
+    dtype = np.result_type(arr, np.float32)
+    ret = uniform_filter1d(arr, size, axis=-1, output=dtype, mode="constant")
+    ret *= size
+    # only keep the elements where the window is fully inside the data
+    start = size // 2
+    stop = start + arr.shape[-1] - size + 1
+    return ret[..., start:stop]
 
 
 def calculate_probability(buffer, window, method="sum"):
@@ -65,7 +123,7 @@ def calculate_probability(buffer, window, method="sum"):
 
     Parameters
     ----------
-    buffer : array(float)
+    buffer : array[nfiles, ..., ncol](float)
         buffer
     window : int
         size of the running window
@@ -75,7 +133,7 @@ def calculate_probability(buffer, window, method="sum"):
 
     Returns
     -------
-    array(float)
+    array[nfiles, ..., ncol - 2 * window](float)
         probabilities
     """
 
@@ -89,8 +147,8 @@ def calculate_probability(buffer, window, method="sum"):
         weights = running_sum(buffer, 2 * window + 1)
         sum_of_weights = np.sum(weights, axis=0)
 
-    # norm probability
-    weights = np.where(sum_of_weights > 0, weights / sum_of_weights, weights)
+    # norm probability, in place and only where the sum is positive
+    np.divide(weights, sum_of_weights, out=weights, where=sum_of_weights > 0)
     return weights
 
 
@@ -100,9 +158,9 @@ def fix_bad_pixels(probability, buffer, readnoise, gain, threshold):
 
     Parameters
     ----------
-    probability : array(float)
+    probability : array[nfiles, ...](float)
         probabilities
-    buffer : array(int)
+    buffer : array[nfiles, ...](int)
         image buffer
     readnoise : float
         readnoise of current amplifier
@@ -113,28 +171,156 @@ def fix_bad_pixels(probability, buffer, readnoise, gain, threshold):
 
     Returns
     -------
-    array(int)
-        input buffer, with bad pixels fixed
+    array[...](int)
+        input buffer, with bad pixels fixed and summed over all files
     """
+    # The intermediate arrays are as large as the buffer, so we reuse them
+    # wherever possible, instead of allocating new ones in each step
+    valid = probability > 0
+
     # Fit signal
-    ratio = np.where(probability > 0, buffer / probability, 0.)
-    amplitude = (
-        np.sum(ratio, axis=0) - np.min(ratio, axis=0) - np.max(ratio, axis=0)
-    ) / (buffer.shape[0] - 2)
+    ratio = np.divide(buffer, probability, out=np.zeros_like(buffer), where=valid)
+    # partition finds the smallest and largest ratio together
+    extremes = np.partition(ratio, (0, -1), axis=0)
+    amplitude = (np.sum(ratio, axis=0) - extremes[0] - extremes[-1]) / (
+        buffer.shape[0] - 2
+    )
 
-    fitted_signal = np.where(probability > 0, amplitude[None, :] * probability, 0)
-    predicted_noise = np.sqrt(readnoise ** 2 + (fitted_signal / gain))
+    # ratio is zero where the probability is not positive
+    fitted_signal = np.multiply(
+        amplitude[None, ...], probability, out=ratio, where=valid
+    )
+    # sig = sqrt(rdnoise**2 + abs(mFit / gain))
+    predicted_noise = np.abs(fitted_signal, out=extremes)
+    predicted_noise *= 1 / gain
+    predicted_noise += readnoise * readnoise
+    np.sqrt(predicted_noise, out=predicted_noise)
 
     # Identify outliers
-    badpixels = buffer - fitted_signal > threshold * predicted_noise
-    nbad = len(np.nonzero(badpixels.flat)[0])
+    corrected_signal = np.subtract(buffer, fitted_signal)
+    predicted_noise *= threshold
+    badpixels = corrected_signal > predicted_noise
+    nbad = np.count_nonzero(badpixels)
 
     # Construct the summed flat
-    corrected_signal = np.where(badpixels, fitted_signal, buffer)
+    np.copyto(corrected_signal, buffer)
+    np.copyto(corrected_signal, fitted_signal, where=badpixels)
     corrected_signal = np.sum(corrected_signal, axis=0)
     return corrected_signal, nbad
 
 
+def combine_amplifier(
+    files,
+    extension,
+    idx,
+    orient,
+    bscale,
+    bzero,
+    window,
+    readnoise,
+    gain,
+    threshold,
+    dtype=np.float32,
+    n_threads=MAX_BLOCK_THREADS,
+):
+    """
+    Combine the image section of a single amplifier from all files,
+    see combine_frames for details
+
+    Parameters
+    ----------
+    files : list(str)
+        list of fits files to combine
+    extension : int
+        fits extension to load
+    idx : tuple(slice, slice)
+        index of the amplifier section in the raw image
+    orient : callable
+        transforms the raw section to [row, column] order and back
+    bscale : array(float)
+        fits scaling factor of each file
+    bzero : array(float)
+        fits zero point of each file
+    window : int
+        horizontal window size
+    readnoise : float
+        readnoise of the amplifier
+    gain : float
+        gain of the amplifier
+    threshold : float
+        threshold for bad pixels
+    dtype : np.dtype, optional
+        datatype of the intermediate arrays (default: float32)
+    n_threads : int, optional
+        number of row blocks to combine at the same time,
+        each needs about 6 arrays of ROW_BLOCK_SIZE rows from all files
+        (default: MAX_BLOCK_THREADS)
+
+    Returns
+    -------
+    corrected : array[nrow, ncol]
+        combined section, in [row, column] order
+    n_bad : int
+        number of fixed pixels
+    """
+
+    def process(rows):
+        # Load the rows of this block from each file
+        # buffer has shape (nfiles, nrows, ncolumns)
+        # Both arrays are completely overwritten, so they don't need to be initialized
+        nrows = len(range(*rows.indices(shape[0])))
+        buffer = np.empty((len(files), nrows, shape[1]), dtype=dtype)
+        probability = np.empty_like(buffer)
+        for i, d in enumerate(data):
+            # Scale the raw data in place, to avoid temporary arrays
+            np.multiply(orient(d[idx])[rows], bscale[i], out=buffer[i])
+            buffer[i] += bzero[i]
+
+        # Calculate probabilities
+        probability[..., window:-window] = calculate_probability(buffer, window)
+
+        # extrapolate to edges
+        # done in place, the mirrored sections do not overlap with the edges
+        left = probability[..., :window]
+        np.multiply(probability[..., window : window + 1], 2, out=left)
+        left -= probability[..., 2 * window : window : -1]
+
+        right = probability[..., -window:]
+        np.multiply(probability[..., -window - 1 : -window], 2, out=right)
+        right -= probability[..., -window - 1 : -2 * window - 1 : -1]
+
+        # fix bad pixels
+        corrected[rows], n_bad = fix_bad_pixels(
+            probability, buffer, readnoise, gain, threshold
+        )
+        return n_bad
+
+    # Opening the files is limited by I/O, so we do it for all files in parallel
+    # Load all images, but leave the data on the disk, using memmap
+    # Need to scale data later
+    n_threads = min(len(files), MAX_IO_THREADS)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        data = list(executor.map(lambda f: open_memmap(f, extension), files))
+
+    # The detector data has at most 16-24 bits, so single precision is enough
+    bscale = np.asarray(bscale, dtype=dtype)
+    bzero = np.asarray(bzero, dtype=dtype)
+    shape = orient(data[0][idx]).shape
+    corrected = np.empty(shape, dtype=dtype)
+
+    # All rows are independent, so we only need to keep a block of rows
+    # from each file in memory at a time, and can process the blocks in parallel
+    # Peak memory is bounded by n_threads blocks, not the whole section
+    blocks = [
+        slice(i, i + ROW_BLOCK_SIZE) for i in range(0, shape[0], ROW_BLOCK_SIZE)
+    ]
+    n_threads = max(1, min(len(blocks), n_threads))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        n_bad = sum(executor.map(process, blocks))
+
+    return corrected, n_bad
+
+
 def combine_frames(
     files,
     instrument,
@@ -159,7 +345,8 @@ def combine_frames(
     If the image orientation is not predominantly vertical, the image is rotated 90 degrees (and rotated back afterwards).
 
     Open all FITS files in the list.
-    Loop through the rows. Read next row from each file into a row buffer mBuff[nCol, nFil].
+    Read the section of each amplifier from each file into a buffer mBuff[nFil, nRow, nCol].
+    The rows are processed in blocks of ROW_BLOCK_SIZE, as described below for a single row.
     Optionally correct the data for non-linearity.
 
     calc_probability::
@@ -229,8 +416,6 @@ def combine_frames(
         combined image data, header
     """
 
-    DEBUG_NROWS = 100  # print status update every DEBUG_NROWS rows (if debug is True)
-
     # summarize file info
     logging.info("Files:")
     for i, fname in zip(range(len(files)), files):
@@ -246,14 +431,14 @@ def combine_frames(
         return result, head
     # Two images
     elif len(files) == 2:
-        bias1, head1 = load_fits(
-            files[0], instrument, mode, extension, dtype=dtype, **kwargs
+        # Read both files at the same time
+        load = lambda f: load_fits(
+            f, instrument, mode, extension, dtype=dtype, **kwargs
         )
-        exp1 = head1.get("exptime", 0)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            (bias1, head1), (bias2, head2) = executor.map(load, files)
 
-        bias2, head2 = load_fits(
-            files[0], instrument, mode, extension, dtype=dtype, **kwargs
-        )
+        exp1 = head1.get("exptime", 0)
         exp2 = head2.get("exptime", 0)
         readnoise = head2.get("e_readn", 0)
 
@@ -269,12 +454,12 @@ def combine_frames(
         # Get information from headers
         # TODO: check if all values are the same in all the headers?
 
-        heads = [
-            load_fits(
-                f, instrument, mode, extension, header_only=True, dtype=dtype, **kwargs
-            )
-            for f in files
-        ]
+        load_header = lambda f: load_fits(
+            f, instrument, mode, extension, header_only=True, dtype=dtype, **kwargs
+        )
+        n_threads = min(len(files), MAX_IO_THREADS)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            heads = list(executor.map(load_header, files))
         head = heads[0]
 
         # if sizes vary, it will show during loading of the data
@@ -303,19 +488,12 @@ def combine_frames(
         total_exposure_time = sum([h.get("exptime", 0) for h in heads])
 
         # Scaling for image data
-        bscale = [h.get("bscale", 1) for h in heads]
-        bzero = [h.get("bzero", 0) for h in heads]
+        bscale = np.array([h.get("bscale", 1) for h in heads], dtype=float)
+        bzero = np.array([h.get("bzero", 0) for h in heads], dtype=float)
 
         result = np.zeros((n_rows, n_columns), dtype=dtype)  # the combined image
         n_fixed = 0  # number of fixed pixels
 
-        # Load all image hdus, but leave the data on the disk, using memmap
-        # Need to scale data later
-        data = [
-            fits.open(f, memmap=True, do_not_scale_image_data=True)[extension]
-            for f in files
-        ]
-
         if window >= n_columns / 2:
             window = n_columns // 10
             logging.warning("Reduce Window size to fit the image")
@@ -323,60 +501,64 @@ def combine_frames(
         # depending on the orientation the indexing changes and the borders of the image change
         if orientation in [1, 3, 4, 6]:
             # idx gives the index for accessing the data in the image, which is rotated depending on the orientation
-            # We could just rotate the whole image, but that requires reading the whole image at once
-            index = lambda row, x_left, x_right: (slice(x_left, x_right), row)
+            # We could just rotate the whole image, but that is done by clipnflip later
+            index = lambda x_left, x_right, y_bottom, y_top: (
+                slice(x_left, x_right),
+                slice(y_bottom, y_top),
+            )
+            # the section is transposed, so that rows are always the second axis of the buffer
+            orient = np.transpose
             # Exchange the borders of the image
             x_low, x_high, y_low, y_high = y_low, y_high, x_low, x_high
         else:
-            index = lambda row, x_left, x_right: (row, slice(x_left, x_right))
+            index = lambda x_left, x_right, y_bottom, y_top: (
+                slice(y_bottom, y_top),
+                slice(x_left, x_right),
+            )
+            orient = np.asarray
 
         # For several amplifiers, different sections of the image are set
         # One for each amplifier, each amplifier is treated seperately
-        for amplifier in range(n_amplifier):
-            # Pick data for current amplifier
-            x_left = x_low[amplifier]
-            x_right = x_high[amplifier]
-            y_bottom = y_low[amplifier]
-            y_top = y_high[amplifier]
-
-            gain_amp = gain[amplifier]
-            readnoise_amp = readnoise[amplifier]
-
-            # Prepare temporary arrays
-            buffer = np.zeros((len(files), x_right - x_left))
-            probability = np.zeros((len(files), x_right - x_left))
-
-            # for each row
-            for row in range(y_bottom, y_top):
-                if (row) % DEBUG_NROWS == 0:
-                    logging.debug(
-                        "%i rows processed - %i pixels fixed so far", row, n_fixed
-                    )
-
-                # load current row
-                idx = index(row, x_left, x_right)
-                for i in range(len(files)):
-                    # TODO: does memmap not work with compressed files?
-                    buffer[i, :] = data[i].data[idx] * bscale[i] + bzero[i]
-
-                # Calculate probabilities
-                probability[:, window:-window] = calculate_probability(buffer, window)
-
-                # extrapolate to edges
-                probability[:, :window] = (
-                    2 * probability[:, window][:, None]
-                    - probability[:, 2 * window : window : -1]
-                )
-                probability[:, -window:] = (
-                    2 * probability[:, -window - 1][:, None]
-                    - probability[:, -window - 1 : -2 * window - 1 : -1]
-                )
-
-                # fix bad pixels
-                result[idx], n_bad = fix_bad_pixels(
-                    probability, buffer, readnoise_amp, gain_amp, threshold
-                )
-                n_fixed += n_bad
+        sections = [
+            index(x_low[amp], x_high[amp], y_low[amp], y_high[amp])
+            for amp in range(n_amplifier)
+        ]
+        arguments = [
+            (
+                files,
+                extension,
+                idx,
+                orient,
+                bscale,
+                bzero,
+                window,
+                readnoise[amp],
+                gain[amp],
+                threshold,
+                dtype,
+                # Share the block threads between the amplifiers
+                max(1, MAX_BLOCK_THREADS // n_amplifier),
+            )
+            for amp, idx in enumerate(sections)
+        ]
+
+        if n_amplifier == 1:
+            results = [combine_amplifier(*arguments[0])]
+        else:
+            # The amplifiers cover seperate parts of the image
+            # so they can be processed in parallel. Threads are enough, as numpy
+            # releases the GIL, and they do not spawn new processes when
+            # combine_frames is already running inside a joblib worker
+            with ThreadPoolExecutor(max_workers=n_amplifier) as executor:
+                results = list(executor.map(combine_amplifier, *zip(*arguments)))
+
+        for amplifier, (idx, (corrected, n_bad)) in enumerate(zip(sections, results)):
+            result[idx] = orient(corrected)
+            n_fixed += n_bad
+
+            logging.debug(
+                "amplifier %i processed - %i pixels fixed so far", amplifier, n_fixed
+            )
 
         logging.info("total cosmic ray hits identified and removed: %i", n_fixed)
 
@@ -507,7 +689,11 @@ def combine_bias(
         # TODO split bias into before and after observation sets, if possible
         try:
             kw = get_instrument_info(instrument)["date"]
-            times = [parser.parse(fits.open(f)[0].header[kw]) for f in files]
+            # Only the headers are needed, read them in parallel
+            load_time = lambda f: parser.parse(fits.getheader(f)[kw])
+            n_threads = min(len(files), MAX_IO_THREADS)
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                times = list(executor.map(load_time, files))
             files = files[np.argsort(times)]
             # np.digitize(science_observation_time, sorted(times))
         except KeyError:
@@ -534,7 +720,9 @@ def combine_bias(
     # Compute noise in difference image by fitting Gaussian to distribution.
     diff = 0.5 * (bias1 - bias2)
     if np.min(diff) != np.max(diff):
-        crude = np.ma.median(np.abs(diff))  # estimate of noise
+        # estimate of noise
+        # np.median uses a partition, instead of sorting the whole image like np.ma.median
+        crude = np.median(np.abs(np.ma.compressed(diff)))
         hmin = -5.0 * crude
         hmax = +5.0 * crude
         bin_size = np.clip(2 / n, 0.5, None)
@@ -551,7 +739,8 @@ def combine_bias(
         imid = np.where(abs(xh) < 2 * noise)
         consig = np.std(contam[imid])
 
-        smcontam = gaussbroad(xh, contam, 0.1 * noise)
+        # The direct convolution is fastest for short histograms
+        smcontam = gaussbroad(xh, contam, 0.1 * noise, force_direct=nbins < 1024)
         igood = np.where(smcontam < 3 * consig)
         gmin = np.min(xh[igood])
         gmax = np.max(xh[igood])
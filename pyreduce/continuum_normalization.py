@@ -8,6 +8,7 @@ First guess of the continuum is provided by the flat field
 from itertools import chain
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import numpy as np
 
 from . import util
@@ -15,7 +16,81 @@ from . import util
 # np.seterr("raise")
 
 
-def splice_orders(spec, wave, cont, sigm, scaling=True, plot=False):
+def overlap_index(wave, mask, wmin, wmax):
+    """
+    Find the points of an order within a given wavelength range
+
+    Uses that the wavelength is monotonic within each order,
+    so the borders of the range can be found with a binary search
+
+    Parameters
+    ----------
+    wave : array[ncol]
+        wavelength of the order
+    mask : array[ncol]
+        mask of the order, masked points are never included
+    wmin : float
+        lower end of the wavelength range
+    wmax : float
+        upper end of the wavelength range
+
+    Returns
+    -------
+    index : array
+        indices of the unmasked points within the range, in increasing order
+    """
+    index = np.flatnonzero(~mask)
+    w = wave[index]
+    if w.size > 1 and w[0] > w[-1]:
+        # Wavelength decreases along the order
+        low = w.size - np.searchsorted(w[::-1], wmax, side="right")
+        high = w.size - np.searchsorted(w[::-1], wmin, side="left")
+    else:
+        low = np.searchsorted(w, wmin, side="left")
+        high = np.searchsorted(w, wmax, side="right")
+    return index[low:high]
+
+
+def masked_ratio(a, b, mask):
+    """ a / b for all points that are not masked, NaN otherwise """
+    return np.divide(a, b, out=np.full(a.shape, np.nan), where=~mask)
+
+
+def interpolation_index(x_old, x_new):
+    """
+    Indices and fractions for the linear interpolation from x_old onto x_new,
+    i.e. y_new = y_old[idx] + frac * (y_old[idx + 1] - y_old[idx])
+
+    Parameters
+    ----------
+    x_old : array of shape (n,)
+        old x values, sorted and without duplicates
+    x_new : array of shape (m,)
+        new x values, within the range of x_old
+
+    Returns
+    -------
+    idx : array of shape (m,)
+        index of the left neighbour in x_old
+    frac : array of shape (m,)
+        relative distance to the left neighbour
+    """
+    idx = np.searchsorted(x_old, x_new, side="right") - 1
+    np.clip(idx, 0, x_old.size - 2, out=idx)
+    frac = (x_new - x_old[idx]) / (x_old[idx + 1] - x_old[idx])
+    return idx, frac
+
+
+def plot_orders(wave, spec):
+    """ Plot all orders into the current axis, as a single artist """
+    ax = plt.gca()
+    colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    lines = LineCollection(np.stack([wave, spec], axis=-1), colors=colors)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+
+
+def splice_orders(spec, wave, cont, sigm, scaling=True, iord0=None, plot=False):
     """
     Splice orders together so that they form a continous spectrum
     This is achieved by linearly combining the overlaping regions
@@ -32,6 +107,9 @@ def splice_orders(spec, wave, cont, sigm, scaling=True, plot=False):
         Errors on the spectrum
     scaling : bool, optional
         If true, the spectrum/continuum will be scaled to 1 (default: False)
+    iord0 : int, optional
+        Reference order, all other orders are spliced relative to it
+        (default: the order with the largest signal)
     plot : bool, optional
         If true, will plot the spliced spectrum (default: False)
 
@@ -49,31 +127,53 @@ def splice_orders(spec, wave, cont, sigm, scaling=True, plot=False):
 
     # Just to be extra safe that they are all the same
     mask = np.ma.getmaskarray(spec) | (spec == 0) | (cont == 0)
-    spec = np.ma.masked_array(spec, mask=mask)
-    wave = np.ma.masked_array(np.ma.getdata(wave), mask=mask)
-    cont = np.ma.masked_array(np.ma.getdata(cont), mask=mask)
-    sigm = np.ma.masked_array(np.ma.getdata(sigm), mask=mask)
+    # Masked arrays are slow, so we work on (copies of) the plain data
+    # and keep track of the mask ourselves
+    # Single precision is plenty for the fluxes, but the wavelength keeps
+    # its precision, as it determines the interpolation
+    dtypes = spec.dtype, cont.dtype, sigm.dtype
+    spec = np.array(np.ma.getdata(spec), dtype=np.float32)
+    wave = np.array(np.ma.getdata(wave))
+    cont = np.array(np.ma.getdata(cont), dtype=np.float32)
+    sigm = np.array(np.ma.getdata(sigm), dtype=np.float32)
+
+    # The median signal of each order, relative to the continuum
+    # Only needed for the scaling or to find the reference order
+    # Fully masked orders have no median (NaN), they are left unscaled
+    if scaling or iord0 is None:
+        ratio = masked_ratio(spec, cont, mask)
+        valid = ~np.all(mask, axis=1)
+        median = np.full(nord, np.nan)
+        median[valid] = np.nanmedian(ratio[valid], axis=1)
 
     if scaling:
         # Scale everything to roughly the same size, around spec/blaze = 1
-        scale = np.ma.median(spec / cont, axis=1)
-        cont *= scale[:, None]
+        cont *= np.where(np.isfinite(median), median, 1)[:, None]
 
     if plot:
         plt.subplot(411)
         plt.title("Before")
-        for i in range(spec.shape[0]):
-            plt.plot(wave[i], spec[i] / cont[i])
+        plot_orders(wave, masked_ratio(spec, cont, mask))
         plt.ylim([0, 2])
 
         plt.subplot(412)
         plt.title("Before Error")
-        for i in range(spec.shape[0]):
-            plt.plot(wave[i], sigm[i] / cont[i])
-        plt.ylim((0, np.ma.median(sigm[i] / cont[i]) * 2))
+        ratio = masked_ratio(sigm, cont, mask)
+        plot_orders(wave, ratio)
+        plt.ylim((0, np.nanmedian(ratio[-1]) * 2))
 
     # Order with largest signal, everything is scaled relative to this order
-    iord0 = np.argmax(np.ma.median(spec / cont, axis=1))
+    # After the scaling all medians are 1, so we use the ones from before
+    if iord0 is None:
+        iord0 = np.nanargmax(median)
+
+    # The wavelength range of each order does not change in the loop
+    wmin = np.min(np.where(mask, np.inf, wave), axis=1)
+    wmax = np.max(np.where(mask, -np.inf, wave), axis=1)
+
+    # Squared signal to noise ratio of the continuum, used as weights
+    # It is kept up to date, whenever the orders are combined below
+    snr2 = masked_ratio(cont, sigm, mask) ** 2
 
     # Loop from iord0 outwards, first to the top, then to the bottom
     tmp0 = chain(range(iord0, 0, -1), range(iord0, nord - 1))
@@ -87,37 +187,42 @@ def splice_orders(spec, wave, cont, sigm, scaling=True, plot=False):
         w0, w1 = wave[iord0], wave[iord1]
         c0, c1 = cont[iord0], cont[iord1]
         u0, u1 = sigm[iord0], sigm[iord1]
+        valid0, valid1 = ~mask[iord0], ~mask[iord1]
+
+        # Nothing to combine with a fully masked order
+        if not (np.any(valid0) and np.any(valid1)):
+            continue
 
         # Calculate Overlap
-        i0 = np.ma.where((w0 >= np.ma.min(w1)) & (w0 <= np.ma.max(w1)))
-        i1 = np.ma.where((w1 >= np.ma.min(w0)) & (w1 <= np.ma.max(w0)))
+        i0 = overlap_index(w0, mask[iord0], wmin[iord1], wmax[iord1])
+        i1 = overlap_index(w1, mask[iord1], wmin[iord0], wmax[iord0])
 
         # Orders overlap
-        if i0[0].size > 0 and i1[0].size > 0:
+        if i0.size and i1.size:
             # Interpolate the overlapping region onto the wavelength grid of the other order
-            tmpS0 = util.bezier_interp(w1, s1, w0[i0])
-            tmpB0 = util.bezier_interp(w1, c1, w0[i0])
-            tmpU0 = util.bezier_interp(w1, u1, w0[i0])
-
-            tmpS1 = util.bezier_interp(w0, s0, w1[i1])
-            tmpB1 = util.bezier_interp(w0, c0, w1[i1])
-            tmpU1 = util.bezier_interp(w0, u0, w1[i1])
-
-            # Combine the two orders weighted by the relative error
-            wgt0 = np.ma.vstack([c0[i0].data / u0[i0].data, tmpB0 / tmpU0]) ** 2
-            wgt1 = np.ma.vstack([c1[i1].data / u1[i1].data, tmpB1 / tmpU1]) ** 2
-
-            s0[i0], utmp = np.ma.average(
-                np.ma.vstack([s0[i0], tmpS0]), axis=0, weights=wgt0, returned=True
+            # spectrum, continuum, and errors share the wavelength grid
+            # so they are interpolated together
+            tmpS0, tmpB0, tmpU0 = util.bezier_interp(
+                w1[valid1], np.array([s1, c1, u1])[:, valid1], w0[i0]
             )
-            c0[i0] = np.ma.average([c0[i0], tmpB0], axis=0, weights=wgt0)
-            u0[i0] = c0[i0] * utmp ** -0.5
-
-            s1[i1], utmp = np.ma.average(
-                np.ma.vstack([s1[i1], tmpS1]), axis=0, weights=wgt1, returned=True
+            tmpS1, tmpB1, tmpU1 = util.bezier_interp(
+                w0[valid0], np.array([s0, c0, u0])[:, valid0], w1[i1]
             )
-            c1[i1] = np.ma.average([c1[i1], tmpB1], axis=0, weights=wgt1)
-            u1[i1] = c1[i1] * utmp ** -0.5
+
+            # Combine the two orders weighted by the relative error
+            wgt0 = snr2[iord0, i0], (tmpB0 / tmpU0) ** 2
+            wgt1 = snr2[iord1, i1], (tmpB1 / tmpU1) ** 2
+
+            # By construction the new (c / u)**2 is just the sum of the weights
+            wsum0 = snr2[iord0, i0] = wgt0[0] + wgt0[1]
+            s0[i0] = (s0[i0] * wgt0[0] + tmpS0 * wgt0[1]) / wsum0
+            c0[i0] = (c0[i0] * wgt0[0] + tmpB0 * wgt0[1]) / wsum0
+            u0[i0] = c0[i0] / np.sqrt(wsum0)
+
+            wsum1 = snr2[iord1, i1] = wgt1[0] + wgt1[1]
+            s1[i1] = (s1[i1] * wgt1[0] + tmpS1 * wgt1[1]) / wsum1
+            c1[i1] = (c1[i1] * wgt1[0] + tmpB1 * wgt1[1]) / wsum1
+            u1[i1] = c1[i1] / np.sqrt(wsum1)
         else:  # Orders dont overlap
             raise NotImplementedError("Orders don't overlap, please test")
             c0 *= util.top(s0 / c0, 1, poly=True)
@@ -140,20 +245,59 @@ def splice_orders(spec, wave, cont, sigm, scaling=True, plot=False):
     if plot:
         plt.subplot(413)
         plt.title("After")
-        for i in range(nord):
-            plt.plot(wave[i], spec[i] / cont[i], label="order=%i" % i)
+        plot_orders(wave, masked_ratio(spec, cont, mask))
         plt.ylim((0, 2))
 
         plt.subplot(414)
         plt.title("Error")
-        for i in range(nord):
-            plt.plot(wave[i], sigm[i] / cont[i], label="order=%i" % i)
-        plt.ylim((0, np.ma.median(sigm[i] / cont[i]) * 2))
+        ratio = masked_ratio(sigm, cont, mask)
+        plot_orders(wave, ratio)
+        plt.ylim((0, np.nanmedian(ratio[-1]) * 2))
         plt.show()
 
+    spec = np.ma.masked_array(spec, mask=mask, dtype=dtypes[0])
+    wave = np.ma.masked_array(wave, mask=mask)
+    cont = np.ma.masked_array(cont, mask=mask, dtype=dtypes[1])
+    sigm = np.ma.masked_array(sigm, mask=mask, dtype=dtypes[2])
     return spec, wave, cont, sigm
 
 
+def refine_top(c, weight, par2, par4, smooth_initial, smooth_final, iterations):
+    """ Approach the upper envelope of c from the top
+
+    Parameters
+    ----------
+    c : array of shape (nwave,)
+        normalized spectrum, will be overwritten
+    weight : array of shape (nwave,)
+        weights of each point
+    par2 : float
+        convergence level of the inner iterations
+    par4 : float
+        convergence level of the final fit
+    smooth_initial : float
+        smoothing parameter of the optimal filter
+    smooth_final : float
+        constraint on the 2nd derivative
+    iterations : int
+        number of inner iterations
+
+    Returns
+    -------
+    top : array of shape (nwave,)
+        smooth upper envelope of c
+    """
+    for _ in range(iterations):
+        _c = util.top(c, smooth_initial, eps=par2, weight=weight, lambda2=smooth_final)
+        # Stop once the fit does not raise c anymore
+        # as all further iterations would then give the same result
+        if np.all(_c <= c):
+            break
+        # Keep the larger value in each point, without creating a new array
+        np.maximum(c, _c, out=c)
+    return util.top(c, smooth_initial, eps=par4, weight=weight, lambda2=smooth_final)
+
+
 class Plot_Normalization:
     def __init__(self, wsort, sB, new_wave, contB, iteration=0):
         plt.ion()
@@ -191,6 +335,7 @@ def continuum_normalize(
     smooth_initial=1e5,
     smooth_final=5e6,
     scale_vert=1,
+    tol=1e-4,
     plot=True,
 ):
     """ Fit a continuum to a spectrum by slowly approaching it from the top.
@@ -219,6 +364,8 @@ def continuum_normalize(
         Smoothing parameter of the final run (default: 5e6)
     scale_vert : float, optional
         Vertical scale of the spectrum. Usually 1 if a previous normalization exists (default: 1)
+    tol : float, optional
+        Stop iterating once the relative change of the continuum is smaller than this (default: 1e-4)
     plot : bool, optional
         Wether to plot the current status and results or not (default: True)
 
@@ -233,59 +380,90 @@ def continuum_normalize(
     par2 = 1e-4
     par4 = 0.01 * (1 - np.clip(2, None, 1 / np.sqrt(np.ma.median(spec))))
 
-    b = np.clip(cont, 1, None)
+    # Smooth each order of the initial guess
+    # util.middle iterates until convergence, so it has to run on each order
+    # separately, but we can at least skip the masked array indexing
+    cont = np.clip(cont, 1, None)
+    valid = ~np.ma.getmaskarray(cont)
+    data = np.ma.getdata(cont)
     for i in range(nord):
-        b[i, ~b.mask[i]] = util.middle(b[i, ~b.mask[i]], 1)
-    cont = b
+        data[i, valid[i]] = util.middle(data[i, valid[i]], 1)
+
+    # Combine all orders into one big spectrum, sorted by wavelength
+    # This is the same as np.unique(..., return_index=True, return_inverse=True)
+    # but without sorting the data twice
+    wsort = np.ma.getdata(wave)[valid]
+    order = np.argsort(wsort, kind="stable")
+    wsort = wsort[order]
+    # Only keep the first of duplicate entries
+    first = np.empty(wsort.size, dtype=bool)
+    first[0] = True
+    np.not_equal(wsort[1:], wsort[:-1], out=first[1:])
+    index = np.empty_like(order)
+    index[order] = np.cumsum(first) - 1
+    j = order[first]
+    wsort = wsort[first]
 
     # Create new equispaced wavelength grid
-    wmin = np.ma.min(wave)
-    wmax = np.ma.max(wave)
+    wmin, wmax = wsort[0], wsort[-1]
     dwave = np.abs(wave[nord // 2, ncol // 2] - wave[nord // 2, ncol // 2 - 1]) * 0.5
-    nwave = np.ceil((wmax - wmin) / dwave) + 1
+    nwave = int(np.ceil((wmax - wmin) / dwave)) + 1
     new_wave = np.linspace(wmin, wmax, nwave, endpoint=True)
 
-    # Combine all orders into one big spectrum, sorted by wavelength
-    wsort, j, index = np.unique(
-        wave.compressed(), return_index=True, return_inverse=True
-    )
-    sB = (spec / cont).compressed()[j]
+    # Only gather the points we use, instead of dividing the whole masked array
+    select = np.flatnonzero(valid)[j]
+    cB = data.ravel()[select]
+    sB = np.ma.getdata(spec).ravel()[select] / cB
 
     # Get initial weights for each point
     weight = util.middle(sB, 0.5, x=wsort - wmin)
-    weight = weight / util.middle(weight, 3 * smooth_initial) + np.concatenate(
-        ([0], 2 * weight[1:-1] - weight[0:-2] - weight[2:], [0])
-    )
-    weight = np.clip(weight, 0, None)
+    # Combine the relative weight and its curvature, without temporary arrays
+    curvature = np.zeros_like(weight)
+    np.multiply(weight[1:-1], 2, out=curvature[1:-1])
+    curvature[1:-1] -= weight[:-2]
+    curvature[1:-1] -= weight[2:]
+    weight /= util.middle(weight, 3 * smooth_initial)
+    weight += curvature
+    np.clip(weight, 0, None, out=weight)
     # TODO for some reason the interpolation messes up, use linear instead for now
     # weight = util.safe_interpolation(wsort, weight, new_wave)
-    weight = np.interp(new_wave, wsort, weight)
+    # Both weights and spectrum are interpolated from wsort onto new_wave,
+    # so we only need to find the interpolation indices once
+    idx, frac = interpolation_index(wsort, new_wave)
+    weight = weight[idx] + frac * (weight[idx + 1] - weight[idx])
     weight /= np.max(weight)
 
     # Interpolate Spectrum onto the new grid
     # ssB = util.safe_interpolation(wsort, sB, new_wave)
-    ssB = np.interp(new_wave, wsort, sB)
+    ssB = sB[idx] + frac * (sB[idx + 1] - sB[idx])
     # Keep the scale of the continuum
-    bbb = util.middle(cont.compressed()[j], 1)
+    bbb = util.middle(cB, 1)
+
+    # Buffers for the weight update, ssB does not change in the loop
+    ssB_clipped = np.clip(ssB, 1, None)
+    upper = np.empty_like(ssB)
 
     contB = 1
+    contB_old = None
     for i in range(iterations):
         # Find new approximation of the top, smoothed by some parameter
-        c = ssB / contB
-        for _ in range(iterations):
-            _c = util.top(
-                c, smooth_initial, eps=par2, weight=weight, lambda2=smooth_final
-            )
-            c = np.clip(_c, c, None)
-        c = (
-            util.top(c, smooth_initial, eps=par4, weight=weight, lambda2=smooth_final)
-            * contB
+        c = refine_top(
+            ssB / contB,
+            weight,
+            par2,
+            par4,
+            smooth_initial,
+            smooth_final,
+            iterations,
         )
+        c *= contB
 
         # Scale it and update the weights of each point
         contB = c * scale_vert
         contB = util.middle(contB, 1)
-        weight = np.clip(ssB / contB, None, contB / np.clip(ssB, 1, None))
+        np.divide(contB, ssB_clipped, out=upper)
+        np.divide(ssB, contB, out=weight)
+        np.minimum(weight, upper, out=weight)
 
         # Plot the intermediate results
         if plot:
@@ -294,6 +472,13 @@ def continuum_normalize(
             else:
                 p.plot(wsort, sB, new_wave, contB, i)
 
+        # Stop early if the continuum has converged
+        if contB_old is not None:
+            delta = np.max(np.abs(contB - contB_old)) / np.max(contB)
+            if delta < tol:
+                break
+        contB_old = contB
+
     # Need to close the plot afterwards
     if plot:
         p.close()
@@ -301,7 +486,7 @@ def continuum_normalize(
     # Calculate the new continuum from intermediate values
     # new_cont = util.safe_interpolation(new_wave, contB, wsort)
     new_cont = np.interp(wsort, new_wave, contB)
-    cont[~cont.mask] = (new_cont * bbb)[index]
+    data[valid] = (new_cont * bbb)[index]
 
     # Final output plot
     if plot:
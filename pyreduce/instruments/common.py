@@ -7,12 +7,34 @@ import datetime
 import glob
 import logging
 import json
+from copy import deepcopy
+from functools import lru_cache
 
 import numpy as np
 from astropy.io import fits
 from dateutil import parser
 
 
+@lru_cache(maxsize=None)
+def load_json(fname):
+    """Load a json file, each file is only read once
+
+    The returned object is shared between all calls, so it must not be modified
+
+    Parameters
+    ----------
+    fname : str
+        filename
+
+    Returns
+    -------
+    data : obj
+        contents of the file
+    """
+    with open(fname) as f:
+        return json.load(f)
+
+
 def find_first_index(arr, value):
     """ find the first element equal to value in the array arr """
     try:
@@ -119,8 +141,8 @@ class instrument:
         this = os.path.dirname(__file__)
         fname = f"{self.instrument.lower()}.json"
         fname = os.path.join(this, fname)
-        with open(fname) as f:
-            info = json.load(f)
+        # The info is modified by the callers, so each one gets its own copy
+        info = deepcopy(load_json(fname))
         return info
 
     def add_header_info(self, header, mode, **kwargs):
@@ -18,10 +18,14 @@ License
 
 """
 
+import hashlib
+import json
 import logging
 import os.path
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from os.path import join
 
 import joblib
@@ -33,7 +37,7 @@ from astropy.io import fits
 from . import echelle, instruments, util
 from .combine_frames import combine_bias, combine_flat
 from .configuration import load_config
-from .continuum_normalization import continuum_normalize, splice_orders
+from .continuum_normalization import continuum_normalize, plot_orders, splice_orders
 from .extract import extract
 from .extraction_width import estimate_extraction_width
 from .make_shear import Curvature as CurvatureModule
@@ -132,6 +136,8 @@ def main(
         else:
             mode = modes
 
+        # Collect all groups of files first, so that they can be run in parallel
+        jobs = []
         for t in target:
             log_file = join(base_dir.format(instrument=i, mode=mode, target=t), "logs/%s.log" % t)
             util.start_logging(log_file)
@@ -151,31 +157,93 @@ def main(
                             m,
                         )
                     for f, k in zip(files, nights):
-                        logging.info("Instrument: %s", i)
-                        logging.info("Target: %s", t)
-                        logging.info("Observation Date: %s", k)
-                        logging.info("Instrument Mode: %s", m)
-
                         if not isinstance(f, dict):
                             f = {1: f}
                         for key, _ in f.items():
-                            logging.info("Group Identifier: %s", key)
-                            logging.debug("Bias files:\n%s", f[key]["bias"])
-                            logging.debug("Flat files:\n%s", f[key]["flat"])
-                            logging.debug("Wavecal files:\n%s", f[key]["wavecal"])
-                            logging.debug("Orderdef files:\n%s", f[key]["orders"])
-                            logging.debug("Science files:\n%s", f[key]["science"])
-                            reducer = Reducer(
-                                f[key],
-                                output_dir,
-                                t,
-                                i,
-                                m,
-                                k,
-                                config,
-                                order_range=order_range,
-                            )
-                            reducer.run_steps(steps=steps)
+                            jobs += [
+                                (f[key], key, output_dir, t, i, m, k, config, log_file)
+                            ]
+
+        # The groups are independent of each other
+        # Note that interactive plots only work with a single job
+        n_jobs = config["reduce"].get("n_jobs", 1)
+        arguments = {"order_range": order_range, "steps": steps}
+        if n_jobs == 1 or len(jobs) <= 1:
+            for job in jobs:
+                reduce_group(*job, **arguments)
+        else:
+            joblib.Parallel(n_jobs=n_jobs)(
+                joblib.delayed(reduce_group)(*job, **arguments) for job in jobs
+            )
+
+
+def reduce_group(
+    files,
+    key,
+    output_dir,
+    target,
+    instrument,
+    mode,
+    night,
+    config,
+    log_file,
+    order_range=None,
+    steps="all",
+):
+    """
+    Run the reduction steps for a single group of files,
+    i.e. one target, night, and instrument mode
+
+    Parameters
+    ----------
+    files : dict(str:list(str))
+        input files for each step
+    key : obj
+        group identifier
+    output_dir : str
+        output directory, may contain tags {instrument}, {night}, {target}, {mode}
+    target : str
+        name of the observation target
+    instrument : str
+        name of the instrument
+    mode : str
+        instrument mode
+    night : str
+        date of the observation
+    config : dict
+        configuration of the current instrument
+    log_file : str
+        name of the logging file
+    order_range : tuple(int, int), optional
+        first and last(+1) order to process (default: all orders)
+    steps : tuple(str), "all", optional
+        which steps of the reduction process to perform (default: "all")
+    """
+    # Each worker process has to set up its own logging
+    util.start_logging(log_file)
+
+    logging.info("Instrument: %s", instrument)
+    logging.info("Target: %s", target)
+    logging.info("Observation Date: %s", night)
+    logging.info("Instrument Mode: %s", mode)
+    logging.info("Group Identifier: %s", key)
+    logging.debug("Bias files:\n%s", files["bias"])
+    logging.debug("Flat files:\n%s", files["flat"])
+    logging.debug("Wavecal files:\n%s", files["wavecal"])
+    logging.debug("Orderdef files:\n%s", files["orders"])
+    logging.debug("Science files:\n%s", files["science"])
+
+    reducer = Reducer(
+        files,
+        output_dir,
+        target,
+        instrument,
+        mode,
+        night,
+        config,
+        order_range=order_range,
+    )
+    reducer.run_steps(steps=steps)
 
 
 class Step:
@@ -207,7 +275,11 @@ class Step:
         #:tuple(int, int): First and Last(+1) order to process
         self.order_range = order_range
         self.plot = config.get("plot", False)
-        self._output_dir = output_dir
+        # The tags do not change after initialization, so we only format them once
+        self._output_dir = output_dir.format(
+            instrument=instrument, target=target, night=night, mode=mode
+        )
+        self._prefix = f"{instrument.lower()}_{mode.lower()}"
 
     def run(self, files, *args):
         """Execute the current step
@@ -261,20 +333,73 @@ class Step:
 
     @property
     def output_dir(self):
-        """str: output directory, may contain tags {instrument}, {night}, {target}, {mode}"""
-        return self._output_dir.format(
-            instrument=self.instrument,
-            target=self.target,
-            night=self.night,
-            mode=self.mode,
-        )
+        """str: output directory, with the tags {instrument}, {night}, {target}, {mode} filled in"""
+        return self._output_dir
 
     @property
     def prefix(self):
         """str: temporary file prefix"""
-        i = self.instrument.lower()
-        m = self.mode.lower()
-        return f"{i}_{m}"
+        return self._prefix
+
+    @property
+    def loads_inputs(self):
+        """bool: Whether load reads the input data directly, instead of saved results"""
+        return False
+
+
+@lru_cache(maxsize=8)
+def load_mask(mask_file, instrument, mode, extension, mtime):
+    """Load a bad pixel mask file
+
+    The same mask is used for all nights of an instrument mode,
+    so the results are cached, instead of reading the file every time
+
+    Parameters
+    ----------
+    mask_file : str
+        Name of the mask data file
+    instrument : str
+        Name of the instrument
+    mode : str
+        Name of the instrument mode
+    extension : int
+        Number of the FITS extension to use
+    mtime : float
+        modification time of the file, so that changed files are read again
+
+    Returns
+    -------
+    mask : array of shape (nrow, ncol)
+        Bad pixel mask, in numpy convention (True for bad pixels)
+    """
+    mask, _ = util.load_fits(mask_file, instrument, mode, extension=extension)
+    # REDUCE mask are inverse to numpy masks, i.e. bad pixels are 0
+    # Comparing with 0 does the cast and the inversion in one pass
+    mask = np.equal(mask.data, 0)
+    return mask
+
+
+@lru_cache(maxsize=16)
+def load_linelist(fname):
+    """Load the reference linelist for the wavelength calibration
+
+    The same linelist is used for all nights of an instrument mode,
+    so the results are cached, instead of unpickling the file every time
+
+    Parameters
+    ----------
+    fname : str
+        Name of the reference linelist file
+
+    Returns
+    -------
+    linelist : record array
+        Reference linelist. This is the cached array, so it needs to be
+        copied before modifying it
+    """
+    with np.load(fname, allow_pickle=True) as reference:
+        linelist = reference["cs_lines"]
+    return linelist
 
 
 class Mask(Step):
@@ -298,6 +423,16 @@ class Mask(Step):
         m = self.mode
         return f"mask_{i}_{m}.fits.gz"
 
+    @property
+    def mask_path(self):
+        """str: Full path of the mask data file"""
+        return join(self.mask_dir, self.mask_file)
+
+    @property
+    def loads_inputs(self):
+        """bool: The mask is always read from the mask file itself"""
+        return True
+
     def run(self):
         """Load the mask file from disk
 
@@ -316,15 +451,19 @@ class Mask(Step):
         mask : array of shape (nrow, ncol)
             Bad pixel mask for this setting
         """
-        mask_file = join(self.mask_dir, self.mask_file)
+        mask_file = self.mask_path
         try:
-            mask, _ = util.load_fits(
-            mask_file, self.instrument, self.mode, extension=self.extension
+            mtime = os.path.getmtime(mask_file)
+            mask = load_mask(
+                mask_file, self.instrument, self.mode, self.extension, mtime
             )
-            mask = ~mask.data.astype(bool)  # REDUCE mask are inverse to numpy masks
+            # Copy, so that changes in one reduction do not affect the next
+            mask = mask.copy()
         except FileNotFoundError:
             logging.error("Bad Pixel Mask datafile %s not found. Using all pixels instead.", mask_file)
-            mask = False
+            # nomask is shared by all masked arrays, instead of each allocating
+            # its own empty mask of the full image size
+            mask = np.ma.nomask
         return mask
 
 
@@ -407,8 +546,10 @@ class Bias(Step):
         bhead : FITS header
             header of the master bias
         """
-        bias = fits.open(self.savefile)[0]
-        bias, bhead = bias.data, bias.header
+        # The data is wrapped in a masked array right away,
+        # so read it into memory and close the file again
+        with fits.open(self.savefile, memmap=False) as hdulist:
+            bias, bhead = hdulist[0].data, hdulist[0].header
         bias = np.ma.masked_array(bias, mask=mask)
         return bias, bhead
 
@@ -493,8 +634,8 @@ class Flat(Step):
         fhead : FITS header
             Master flat FITS header
         """
-        flat = fits.open(self.savefile)[0]
-        flat, fhead = flat.data, flat.header
+        with fits.open(self.savefile, memmap=False) as hdulist:
+            flat, fhead = hdulist[0].data, hdulist[0].header
         flat = np.ma.masked_array(flat, mask=mask)
         return flat, fhead
 
@@ -597,9 +738,11 @@ class OrderTracing(Step):
         column_range : array of shape (nord, 2)
             first and last(+1) column that carries signal in each order
         """
-        data = np.load(self.savefile, allow_pickle=True)
-        orders = data["orders"]
-        column_range = data["column_range"]
+        # The arrays are read as soon as they are accessed,
+        # so the file can be closed right away
+        with np.load(self.savefile) as data:
+            orders = data["orders"]
+            column_range = data["column_range"]
         return orders, column_range
 
 
@@ -672,7 +815,10 @@ class NormalizeFlatField(Step):
             **self.extraction_kwargs,
         )
 
-        blaze = np.ma.filled(blaze, 0)
+        # Fill the masked values in place, instead of creating a filled copy
+        if np.ma.is_masked(blaze):
+            np.copyto(blaze.data, 0, where=blaze.mask)
+        blaze = np.ma.getdata(blaze)
 
         # Save data
         self.save(norm, blaze)
@@ -702,9 +848,9 @@ class NormalizeFlatField(Step):
             Continuum level as determined from the flat field for each order
         """
         logging.info("Loading normalized flat field")
-        data = np.load(self.savefile, allow_pickle=True)
-        blaze = data["blaze"]
-        norm = data["norm"]
+        with np.load(self.savefile) as data:
+            blaze = data["blaze"]
+            norm = data["norm"]
         return norm, blaze
 
 
@@ -809,8 +955,9 @@ class WavelengthCalibration(Step):
         reference = instruments.instrument_info.get_wavecal_filename(
             thead, self.instrument, self.mode
         )
-        reference = np.load(reference, allow_pickle=True)
-        linelist = reference["cs_lines"]
+        # The linelist is modified during the wavelength calibration,
+        # so we need our own copy of the cached data
+        linelist = load_linelist(reference).copy()
 
         module = WavelengthCalibrationModule(
             plot=self.plot,
@@ -862,11 +1009,11 @@ class WavelengthCalibration(Step):
         linelist : record array of shape (nlines,)
             Updated line information for all lines
         """
-        data = np.load(self.savefile, allow_pickle=True)
-        wave = data["wave"]
-        thar = data["thar"]
-        coef = data["coef"]
-        linelist = data["linelist"]
+        with np.load(self.savefile, allow_pickle=True) as data:
+            wave = data["wave"]
+            thar = data["thar"]
+            coef = data["coef"]
+            linelist = data["linelist"]
         return wave, thar, coef, linelist
 
 class LaserFrequencyComb(Step):
@@ -935,7 +1082,7 @@ class LaserFrequencyComb(Step):
 
         f = files[0]
         orig, chead = util.load_fits(
-            f, self.instrument, self.mode, self.extension, mask=mask
+            f, self.instrument, self.mode, self.extension, mask=mask, dtype=np.float32
         )
 
         comb, _, _, _ = extract(
@@ -1061,7 +1208,7 @@ class SlitCurvatureDetermination(Step):
         # TODO: Pick best image / combine images ?
         f = files[0]
         orig, head = util.load_fits(
-            f, self.instrument, self.mode, self.extension, mask=mask
+            f, self.instrument, self.mode, self.extension, mask=mask, dtype=np.float32
         )
 
         extracted, _, _, _ = extract(
@@ -1151,6 +1298,8 @@ class ScienceExtraction(Step):
             raise ValueError(
                 f"Extraction method {self.extraction_method} not supported for step 'science'"
             )
+        #:int: Number of observations to extract in parallel
+        self.n_jobs = config.get("n_jobs", 1)
 
     def science_file(self, name):
         """Name of the science file in disk, based on the input file
@@ -1201,45 +1350,160 @@ class ScienceExtraction(Step):
         orders, column_range = orders
         tilt, shear = curvature
 
-        heads, specs, sigmas, columns = [], [], [], []
-        for fname in files:
-            im, head = util.load_fits(
-                fname,
-                self.instrument,
-                self.mode,
-                self.extension,
-                mask=mask,
-                dtype=np.floating,
-            )
-            # Correct for bias and flat field
-            im -= bias
-            im /= norm
-
-            # Optimally extract science spectrum
-            spec, sigma, _, column_range = extract(
-                im,
-                orders,
-                tilt=tilt,
-                shear=shear,
-                gain=head["e_gain"],
-                readnoise=head["e_readn"],
-                dark=head["e_drk"],
-                extraction_type=self.extraction_method,
-                column_range=column_range,
-                order_range=self.order_range,
-                plot=self.plot,
-                **self.extraction_kwargs,
+        # The observations are corrected in single precision, which is plenty
+        # for the detector data, so convert the calibrations only once here
+        bias = np.ma.asarray(bias, dtype=np.float32)
+        norm = np.ma.asarray(norm, dtype=np.float32)
+        # joblib shares large plain arrays with the workers as memory maps,
+        # but would copy masked arrays, so pass the data and mask separately
+        bias = (np.ma.getdata(bias), np.ma.getmaskarray(bias))
+        norm = (np.ma.getdata(norm), np.ma.getmaskarray(norm))
+
+        # The observations are independent of each other
+        # Note that interactive plots only work with a single job
+        arguments = (bias, norm, orders, column_range, tilt, shear, mask)
+        if self.n_jobs == 1 or self.plot or len(files) <= 1:
+            # Read the next observation and write the previous results
+            # in the background, while the current one is extracted
+            results, saved = [], []
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                load = lambda f: executor.submit(self.load_file, f, bias, norm, mask)
+                future = load(files[0]) if len(files) > 0 else None
+                for i, fname in enumerate(files):
+                    image = future.result()
+                    if i + 1 < len(files):
+                        future = load(files[i + 1])
+                    result = self.extract_file(
+                        fname, *arguments, image=image, save=False
+                    )
+                    saved += [executor.submit(self.save, fname, *result)]
+                    results += [result]
+                # Raise any errors from writing the files
+                for future in saved:
+                    future.result()
+        else:
+            results = joblib.Parallel(n_jobs=self.n_jobs)(
+                joblib.delayed(self.extract_file)(fname, *arguments)
+                for fname in files
             )
 
-            # save spectrum to disk
-            self.save(fname, head, spec, sigma, column_range)
+        heads, specs, sigmas, columns = [], [], [], []
+        for head, spec, sigma, cr in results:
             heads.append(head)
             specs.append(spec)
             sigmas.append(sigma)
-            columns.append(column_range)
+            columns.append(cr)
 
         return heads, specs, sigmas, columns
 
+    def load_file(self, fname, bias, norm, mask):
+        """Load a single observation and correct it for bias and flat field
+
+        Parameters
+        ----------
+        fname : str
+            observation file
+        bias : tuple(array of shape (nrow, ncol), array of shape (nrow, ncol))
+            data and mask of the master bias
+        norm : tuple(array of shape (nrow, ncol), array of shape (nrow, ncol))
+            data and mask of the normalized flat field
+        mask : array of shape (nrow, ncol)
+            bad pixel map
+
+        Returns
+        -------
+        im : masked array of shape (nrow, ncol)
+            corrected observation
+        head : FITS header
+            FITS header of the observation
+        """
+        im, head = util.load_fits(
+            fname,
+            self.instrument,
+            self.mode,
+            self.extension,
+            mask=mask,
+            dtype=np.float32,
+        )
+        # Correct for bias and flat field
+        im -= np.ma.masked_array(*bias)
+        im /= np.ma.masked_array(*norm)
+        return im, head
+
+    def extract_file(
+        self,
+        fname,
+        bias,
+        norm,
+        orders,
+        column_range,
+        tilt,
+        shear,
+        mask,
+        image=None,
+        save=True,
+    ):
+        """Extract and save the spectrum of a single observation
+
+        Parameters
+        ----------
+        fname : str
+            observation file
+        bias : tuple(array of shape (nrow, ncol), array of shape (nrow, ncol))
+            data and mask of the master bias
+        norm : tuple(array of shape (nrow, ncol), array of shape (nrow, ncol))
+            data and mask of the normalized flat field
+        orders : array of shape (nord, ndegree+1)
+            polynomial coefficients for each order
+        column_range : array of shape (nord, 2)
+            first and last(+1) column that carries signal in each order
+        tilt : array of shape (nord, ncol)
+            slit tilt
+        shear : array of shape (nord, ncol)
+            slit shear
+        mask : array of shape (nrow, ncol)
+            bad pixel map
+        image : tuple(masked array, FITS header), optional
+            the observation, already loaded by load_file (default: load it here)
+        save : bool, optional
+            whether to save the results to disk (default: True)
+
+        Returns
+        -------
+        head : FITS header
+            FITS header of the observation
+        spec : array of shape (nord, ncol)
+            extracted spectrum
+        sigma : array of shape (nord, ncol)
+            uncertainties of the extracted spectrum
+        column_range : array of shape (nord, 2)
+            column range of the extracted spectrum
+        """
+        if image is None:
+            image = self.load_file(fname, bias, norm, mask)
+        im, head = image
+
+        # Optimally extract science spectrum
+        spec, sigma, _, column_range = extract(
+            im,
+            orders,
+            tilt=tilt,
+            shear=shear,
+            gain=head["e_gain"],
+            readnoise=head["e_readn"],
+            dark=head["e_drk"],
+            extraction_type=self.extraction_method,
+            column_range=column_range,
+            order_range=self.order_range,
+            plot=self.plot,
+            **self.extraction_kwargs,
+        )
+
+        # save spectrum to disk
+        if save:
+            self.save(fname, head, spec, sigma, column_range)
+        return head, spec, sigma, column_range
+
     def save(self, fname, head, spec, sigma, column_range):
         """Save the results of one extraction
 
@@ -1297,6 +1561,8 @@ class ContinuumNormalization(Step):
     def __init__(self, *args, **config):
         super().__init__(*args, **config)
         self._dependsOn += ["science", "freq_comb", "norm_flat"]
+        #:int: Number of observations to normalize in parallel
+        self.n_jobs = config.get("n_jobs", 1)
 
     @property
     def savefile(self):
@@ -1334,20 +1600,57 @@ class ContinuumNormalization(Step):
         norm, blaze = norm_flat
 
         logging.info("Continuum normalization")
-        conts = [None for _ in specs]
-        for j, (spec, sigma) in enumerate(zip(specs, sigmas)):
-            logging.info("Splicing orders")
-            specs[j], wave, blaze, sigmas[j] = splice_orders(
-                spec, wave, blaze, sigma, scaling=True, plot=self.plot
-            )
-            logging.info("Normalizing continuum")
-            conts[j] = continuum_normalize(
-                specs[j], wave, blaze, sigmas[j], plot=self.plot
+        # The observations are independent of each other
+        # Note that interactive plots only work with a single job
+        if self.n_jobs == 1 or self.plot or len(specs) <= 1:
+            results = [
+                self.normalize(spec, wave, blaze, sigma)
+                for spec, sigma in zip(specs, sigmas)
+            ]
+        else:
+            results = joblib.Parallel(n_jobs=self.n_jobs)(
+                joblib.delayed(self.normalize)(spec, wave, blaze, sigma)
+                for spec, sigma in zip(specs, sigmas)
             )
 
+        specs = [spec for spec, _, _ in results]
+        sigmas = [sigma for _, sigma, _ in results]
+        conts = [cont for _, _, cont in results]
+
         self.save(heads, specs, sigmas, conts, columns)
         return heads, specs, sigmas, conts, columns
 
+    def normalize(self, spec, wave, blaze, sigma):
+        """Splice the orders and determine the continuum of a single observation
+
+        Parameters
+        ----------
+        spec : array of shape (nord, ncol)
+            extracted spectrum
+        wave : array of shape (nord, ncol)
+            wavelength solution
+        blaze : array of shape (nord, ncol)
+            blaze function from the flat field
+        sigma : array of shape (nord, ncol)
+            uncertainties of the extracted spectrum
+
+        Returns
+        -------
+        spec : array of shape (nord, ncol)
+            spliced spectrum
+        sigma : array of shape (nord, ncol)
+            spliced uncertainties
+        cont : array of shape (nord, ncol)
+            continuum of the spectrum
+        """
+        logging.info("Splicing orders")
+        spec, wave, blaze, sigma = splice_orders(
+            spec, wave, blaze, sigma, scaling=True, plot=self.plot
+        )
+        logging.info("Normalizing continuum")
+        cont = continuum_normalize(spec, wave, blaze, sigma, plot=self.plot)
+        return spec, sigma, cont
+
     def save(self, heads, specs, sigmas, conts, columns):
         """Save the results from the continuum normalization
 
@@ -1364,14 +1667,16 @@ class ContinuumNormalization(Step):
         columns : list(array of shape (nord, 2))
             column ranges for each spectra
         """
+        # Store plain arrays instead of a pickle of the whole lists
+        # The final echelle files are single precision, so that is enough here
         value = {
-            "heads": heads,
-            "specs": specs,
-            "sigmas": sigmas,
-            "conts": conts,
-            "columns": columns,
+            "heads": np.array([fits.Header(h).tostring() for h in heads], dtype=str),
+            "columns": np.array(columns),
         }
-        joblib.dump(value, self.savefile)
+        for name, arrays in zip(("specs", "sigmas", "conts"), (specs, sigmas, conts)):
+            value[name] = np.array([np.ma.getdata(a) for a in arrays], np.float32)
+            value[name + "_mask"] = np.array([np.ma.getmaskarray(a) for a in arrays])
+        np.savez(self.savefile, **value)
 
     def load(self):
         """Load the results from the continuum normalization
@@ -1389,12 +1694,18 @@ class ContinuumNormalization(Step):
         columns : list(array of shape (nord, 2))
             column ranges for each spectra
         """
-        data = joblib.load(self.savefile)
-        heads = data["heads"]
-        specs = data["specs"]
-        sigmas = data["sigmas"]
-        conts = data["conts"]
-        columns = data["columns"]
+        try:
+            with np.load(self.savefile) as data:
+                heads = [fits.Header.fromstring(h) for h in data["heads"]]
+                specs, sigmas, conts = [
+                    list(np.ma.masked_array(data[name], mask=data[name + "_mask"]))
+                    for name in ("specs", "sigmas", "conts")
+                ]
+                columns = list(data["columns"])
+        except (ValueError, KeyError):
+            # Files from older versions are pickles with a different layout,
+            # treat them as missing so that the step is run again
+            raise FileNotFoundError(f"Outdated continuum file {self.savefile}")
         return heads, specs, sigmas, conts, columns
 
 
@@ -1426,6 +1737,14 @@ class Finalize(Step):
         heads, specs, sigmas, conts, columns = continuum
         wave, comb = freq_comb
 
+        # Calculate the heliocentric corrections of all observations at once,
+        # astropy evaluates the ephemeris for all of them together
+        if len(heads) > 0:
+            keys = ("e_obslon", "e_obslat", "e_obsalt", "ra", "dec", "e_jd")
+            rv_corrs, bjds = util.helcorr(
+                *[np.array([head[key] for head in heads]) for key in keys]
+            )
+
         # Combine science with wavecal and continuum
         for i, (head, spec, sigma, blaze) in enumerate(
             zip(heads, specs, sigmas, conts)
@@ -1433,14 +1752,7 @@ class Finalize(Step):
             head["e_erscle"] = ("absolute", "error scale")
 
             # Add heliocentric correction
-            rv_corr, bjd = util.helcorr(
-                head["e_obslon"],
-                head["e_obslat"],
-                head["e_obsalt"],
-                head["ra"],
-                head["dec"],
-                head["e_jd"],
-            )
+            rv_corr, bjd = rv_corrs[i], bjds[i]
 
             logging.debug("Heliocentric correction: %f km/s", rv_corr)
             logging.debug("Heliocentric Julian Date: %s", str(bjd))
@@ -1449,8 +1761,8 @@ class Finalize(Step):
             head["e_jd"] = bjd
 
             if self.plot:
-                for j in range(spec.shape[0]):
-                    plt.plot(wave[j], spec[j] / blaze[j])
+                # Masked points are set to NaN, to leave gaps in the lines
+                plot_orders(wave, np.ma.filled(spec / blaze, np.nan))
                 plt.show()
 
             fname = self.save(i, head, spec, sigma, blaze, wave, columns[i])
@@ -1563,6 +1875,10 @@ class Reducer:
 
 
         self.data = {}
+        #:dict(str:str): Cache keys of the inputs of each step
+        self.keys = {}
+        #:bool: Whether to reuse previous results, if the inputs did not change
+        self.use_cache = config.get("reduce", {}).get("use_cache", False)
         self.inputs = (
             instrument,
             mode,
@@ -1574,6 +1890,87 @@ class Reducer:
         )
         self.config = config
 
+    def cache_key(self, step, module):
+        """Hash of all inputs that determine the results of a step
+
+        This includes the settings of the step, the name, modification time,
+        and size of each input file and of the bad pixel mask,
+        and the keys of the steps it depends on.
+
+        Parameters
+        ----------
+        step : str
+            name of the step
+        module : Step
+            the step object
+
+        Returns
+        -------
+        key : str, None
+            hexadecimal hash of the inputs,
+            or None if the results of a dependency can not be verified
+        """
+        dependencies = [self.keys.get(d) for d in module.dependsOn]
+        if None in dependencies:
+            return None
+        files = list(self.files.get(step, []))
+        # The mask is loaded from a file outside of the given files
+        mask = self.modules["mask"](*self.inputs, **self.config.get("mask", {}))
+        if os.path.exists(mask.mask_path):
+            files.append(mask.mask_path)
+        state = {
+            "step": step,
+            "inputs": self.inputs,
+            "config": self.config.get(step, {}),
+            "files": [(f, os.path.getmtime(f), os.path.getsize(f)) for f in files],
+            "dependencies": dependencies,
+        }
+        state = json.dumps(state, sort_keys=True, default=str)
+        return hashlib.blake2b(state.encode(), digest_size=8).hexdigest()
+
+    @staticmethod
+    def cache_file(step, module):
+        """str: Name of the file that stores the cache key of a step"""
+        return join(module.output_dir, ".cache", f"{module.prefix}.{step}.key")
+
+    def read_key(self, step, module):
+        """Read the cache key of the last run of a step, or None if there is none"""
+        try:
+            with open(self.cache_file(step, module)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def write_key(self, step, module, key):
+        """Store the cache key of a step, next to its results
+
+        If key is None, an existing key is removed instead, so that
+        the new results are never mistaken for those of an earlier run
+        """
+        fname = self.cache_file(step, module)
+        if key is None:
+            if os.path.exists(fname):
+                os.remove(fname)
+            return
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, "w") as f:
+            f.write(key)
+
+    def verified_key(self, step):
+        """Cache key of the saved results of a step, or None if they are outdated
+
+        The keys of the dependencies are determined as well, without loading them
+        """
+        if step not in self.keys:
+            module = self.modules[step](*self.inputs, **self.config.get(step, {}))
+            for dependency in module.dependsOn:
+                self.verified_key(dependency)
+            key = self.cache_key(step, module)
+            if not (module.loads_inputs or key == self.read_key(step, module)):
+                key = None
+            self.keys[step] = key
+        return self.keys[step]
+
     def run_module(self, step, load=False):
         # The Module this step is based on (An object of the Step class)
         module = self.modules[step](*self.inputs, **self.config.get(step, {}))
@@ -1592,16 +1989,35 @@ class Reducer:
             try:
                 logging.info("Loading data from step '%s'", step)
                 data = module.load(**args)
+                if self.use_cache:
+                    self.verified_key(step)
             except FileNotFoundError:
                 logging.warning(
                     "Intermediate File(s) for loading step %s not found. Running it instead.", step
                 )
                 data = self.run_module(step, load=False)
         else:
-            logging.info("Running step '%s'", step)
-            if step in self.files.keys():
-                args["files"] = self.files[step]
-            data = module.run(**args)
+            data, key = None, None
+            if self.use_cache:
+                # Skip the step, if its inputs did not change since the last run
+                key = self.cache_key(step, module)
+                if key is not None and key == self.read_key(step, module):
+                    try:
+                        logging.info("Inputs of step '%s' did not change", step)
+                        data = module.load(
+                            **{d: args[d] for d in module.loadDependsOn}
+                        )
+                    except (FileNotFoundError, NotImplementedError):
+                        data = None
+            if data is None:
+                logging.info("Running step '%s'", step)
+                if step in self.files.keys():
+                    args["files"] = self.files[step]
+                data = module.run(**args)
+                # Without caching the key is removed, as it no longer matches
+                self.write_key(step, module, key)
+            if self.use_cache:
+                self.keys[step] = key
 
         self.data[step] = data
         return data
@@ -355,8 +355,9 @@ def mark_orders(
     """
 
     # Convert to signed integer, to avoid underflow problems
+    # 32 bit are plenty for detector data, and half the size of the default int
     im = np.asarray(im)
-    im = im.astype(int)
+    im = im.astype(np.int32)
 
     if filter_size is None:
         col = im[:, im.shape[0] // 2]
@@ -395,7 +396,8 @@ def mark_orders(
     elif not np.isscalar(noise):
         raise TypeError(f"Expected scalar noise level, but got {noise}")
 
-    threshold = np.ma.median(blurred - im, axis=0)
+    # im is a plain array, so np.median (with partition) is enough
+    threshold = np.median(blurred - im, axis=0)
     mask = im > blurred + noise + np.abs(threshold)
     # remove borders
     if border_width != 0:
@@ -417,8 +419,8 @@ def mark_orders(
     sizes = np.bincount(clusters.ravel())
     mask_sizes = sizes > min_cluster
     mask_sizes[0] = True  # This is the background, which we don't need to remove
-    for i in np.arange(len(sizes))[~mask_sizes]:
-        clusters[clusters == i] = 0
+    # Use the cluster sizes as lookup table, instead of looping over all small clusters
+    clusters[~mask_sizes[clusters]] = 0
 
     # # Reorganize x, y, clusters into a more convenient "pythonic" format
     # # x, y become dictionaries, with an entry for each order
@@ -5,6 +5,7 @@ Collection of various useful and/or reoccuring functions across PyReduce
 import argparse
 import logging
 import os
+from functools import lru_cache
 from itertools import product
 
 import matplotlib.pyplot as plt
@@ -14,7 +15,15 @@ from astropy.io import fits
 from astropy import time, coordinates as coord, units as u
 import scipy.constants
 import scipy.interpolate
-from scipy.linalg import solve, solve_banded, lstsq
+import scipy.signal
+from scipy.linalg import (
+    LinAlgError,
+    cho_solve_banded,
+    cholesky_banded,
+    lstsq,
+    solve,
+    solve_banded,
+)
 from scipy.ndimage.filters import median_filter
 from scipy.optimize import curve_fit, least_squares
 
@@ -205,19 +214,26 @@ def load_fits(
 
     ONLY the header is returned if header_only is True 
     """
+    if header_only:
+        # Use our own copy, as the header is usually modified by the caller
+        mtime = os.path.getmtime(fname)
+        return load_header(fname, instrument, mode, extension, mtime).copy()
+
     hdu = fits.open(fname)
     header = hdu[extension].header
     header.extend(hdu[0].header, strip=False)
     header = modeinfo(header, instrument, mode)
 
-    if header_only:
-        hdu.close()
-        return header
-
     data = clipnflip(hdu[extension].data, header)
 
+    # FITS data is big endian, and every operation on it would need to
+    # swap the bytes first, so convert it once to native byte order
+    # (together with the requested datatype)
+    # The copy is also C-contiguous, even if the clipped and flipped image is not
+    if dtype is None and not data.dtype.isnative:
+        dtype = data.dtype.newbyteorder("=")
     if dtype is not None:
-        data = data.astype(dtype)
+        data = data.astype(dtype, order="C")
 
     data = np.ma.masked_array(data, mask=mask)
 
@@ -225,6 +241,40 @@ def load_fits(
     return data, header
 
 
+@lru_cache(maxsize=256)
+def load_header(fname, instrument, mode, extension, mtime):
+    """
+    load the header of a fits file, REDUCE style, see load_fits
+
+    The same files are used in several steps, and parsing the header
+    is slow, so the results are cached
+
+    Parameters
+    ----------
+    fname : str
+        filename
+    instrument : str
+        name of the instrument
+    mode : str
+        instrument mode
+    extension : int
+        data extension of the FITS file to load
+    mtime : float
+        modification time of the file, so that changed files are read again
+
+    Returns
+    --------
+    header : fits.header
+        FITS header (Primary and Extension + Modeinfo).
+        This is the cached object, so it needs to be copied before modifying it
+    """
+    with fits.open(fname) as hdu:
+        header = hdu[extension].header
+        header.extend(hdu[0].header, strip=False)
+    header = modeinfo(header, instrument, mode)
+    return header
+
+
 def swap_extension(fname, ext, path=None):
     """ exchange the extension of the given file with a new one """
     if path is None:
@@ -239,6 +289,13 @@ def swap_extension(fname, ext, path=None):
 
 def find_first_index(arr, value):
     """ find the first element equal to value in the array arr """
+    if isinstance(arr, np.ndarray) and arr.ndim == 1:
+        # Compare all elements at once, argmax returns the first True
+        hits = np.asarray(arr == value)
+        i = np.argmax(hits) if hits.size > 0 else 0
+        if hits.size == 0 or not hits[i]:
+            raise Exception("Value %s not found" % value)
+        return int(i)
     try:
         return next(i for i, v in enumerate(arr) if v == value)
     except StopIteration:
@@ -287,9 +344,11 @@ def cutout_image(img, ymin, ymax, xmin, xmax):
         selection of the image
     """
 
-    cutout = np.zeros((ymax[0] - ymin[0] + 1, xmax - xmin), dtype=img.dtype)
-    for i, x in enumerate(range(xmin, xmax)):
-        cutout[:, i] = img[ymin[x] : ymax[x] + 1, x]
+    # Select all columns at once, the height is the same in each column
+    height = ymax[0] - ymin[0] + 1
+    cols = np.arange(xmin, xmax)
+    rows = ymin[cols] + np.arange(height)[:, None]
+    cutout = np.asarray(img)[rows, cols]
     return cutout
 
 
@@ -329,16 +388,13 @@ def make_index(ymin, ymax, xmin, xmax, zero=0):
     if zero:
         zero = xmin
 
-    index_x = np.array(
-        [np.arange(ymin[col], ymax[col] + 1) for col in range(xmin - zero, xmax - zero)]
-    )
-    index_y = np.array(
-        [
-            np.full(ymax[col] - ymin[col] + 1, col)
-            for col in range(xmin - zero, xmax - zero)
-        ]
-    )
-    index = index_x.T, index_y.T + zero
+    # Broadcast the rows and columns of all pixels at once,
+    # using the height of the first column
+    cols = np.arange(xmin - zero, xmax - zero)
+    height = ymax[cols[0]] - ymin[cols[0]] + 1 if cols.size > 0 else 0
+    index_x = ymin[cols] + np.arange(height)[:, None]
+    index_y = np.tile(cols + zero, (height, 1))
+    index = index_x, index_y
 
     return index
 
@@ -457,7 +513,7 @@ def gaussfit3(x, y):
 
     with np.warnings.catch_warnings():
         np.warnings.simplefilter("ignore")
-        popt, _ = curve_fit(gauss, x, y, p0=p0)
+        popt, _ = curve_fit(gauss, x, y, p0=p0, jac=gaussval2_jac)
 
     return popt
 
@@ -486,7 +542,7 @@ def gaussfit4(x, y):
 
     with np.warnings.catch_warnings():
         np.warnings.simplefilter("ignore")
-        popt, _ = curve_fit(gauss, x, y, p0=p0)
+        popt, _ = curve_fit(gauss, x, y, p0=p0, jac=gaussval2_jac)
 
     return popt
 
@@ -522,9 +578,14 @@ def gaussfit_linear(x, y):
     G[:, 0] = x ** 2
     G[:, 1] = x
 
-    beta, _, _, _ = np.linalg.lstsq(
-        (G.T * weights ** 2).T, d * weights ** 2, rcond=None
-    )
+    # Solve the weighted least squares problem via its 3x3 normal equations
+    w = weights ** 4
+    M, rhs = (G.T * w) @ G, (G.T * w) @ d
+    try:
+        beta = np.linalg.solve(M, rhs)
+    except np.linalg.LinAlgError:
+        # Rank deficient, e.g. fewer than 3 distinct x values
+        beta, *_ = np.linalg.lstsq(M, rhs, rcond=None)
 
     a = np.exp(beta[2] - beta[1] ** 2 / (4 * beta[0]))
     sig = -1 / (2 * beta[0])
@@ -537,7 +598,58 @@ def gaussval2(x, a, mu, sig, const):
     return a * np.exp(-(x - mu) ** 2 / (2 * sig)) + const
 
 
-def gaussbroad(x, y, hwhm):
+def gaussval2_jac(x, a, mu, sig, const):
+    """Analytic Jacobian of gaussval2 with respect to (a, mu, sig, const)
+
+    Passing this to curve_fit avoids the finite difference estimate,
+    which needs one extra function evaluation per parameter.
+
+    Returns
+    -------
+    jac : array of shape (n, 4)
+        derivatives of gaussval2 at each x
+    """
+    t = x - mu
+    e = np.exp(-(t ** 2) / (2 * sig))
+    jac = np.empty((np.size(x), 4))
+    jac[:, 0] = e
+    jac[:, 1] = a * e * t / sig
+    jac[:, 2] = a * e * t ** 2 / (2 * sig ** 2)
+    jac[:, 3] = 1
+    return jac
+
+
+@lru_cache(maxsize=32)
+def gauss_kernel(hwhm, dw):
+    """
+    Unit area gaussian kernel with half width half maximum hwhm,
+    sampled with step dw, as used by gaussbroad
+
+    The result is cached and must not be modified.
+
+    Parameters
+    ----------
+    hwhm : float > 0
+        half width half maximum
+    dw : float > 0
+        sampling step of the data
+    Returns
+    -------
+    array(float)
+        normalized kernel, with an odd number of points
+    """
+    nhalf = int(3.3972872 * hwhm / dw)
+    ng = 2 * nhalf + 1  # points in gaussian (odd!)
+    # wavelength scale of gaussian
+    wg = dw * (np.arange(0, ng, 1, dtype=float) - (ng - 1) / 2)
+    xg = (0.83255461 / hwhm) * wg  # convenient absisca
+    gpro = (0.46974832 * dw / hwhm) * np.exp(-xg * xg)  # unit area gaussian w/ FWHM
+    gpro = gpro / np.sum(gpro)
+    gpro.flags.writeable = False
+    return gpro
+
+
+def gaussbroad(x, y, hwhm, force_direct=False):
     """
     Apply gaussian broadening to x, y data with half width half maximum hwhm
 
@@ -549,6 +661,10 @@ def gaussbroad(x, y, hwhm):
         y values
     hwhm : float > 0
         half width half maximum
+    force_direct : bool, optional
+        if True always use the direct convolution, otherwise switch to a
+        FFT based convolution for large data and kernels, which is faster there.
+        For short data the direct method is always faster (default: False)
     Returns
     -------
     array(float)
@@ -565,20 +681,16 @@ def gaussbroad(x, y, hwhm):
     if hwhm > 5 * (x[-1] - x[0]):
         return np.full(len(x), sum(y) / len(x))
 
-    nhalf = int(3.3972872 * hwhm / dw)
-    ng = 2 * nhalf + 1  # points in gaussian (odd!)
-    # wavelength scale of gaussian
-    wg = dw * (np.arange(0, ng, 1, dtype=float) - (ng - 1) / 2)
-    xg = (0.83255461 / hwhm) * wg  # convenient absisca
-    gpro = (0.46974832 * dw / hwhm) * np.exp(-xg * xg)  # unit area gaussian w/ FWHM
-    gpro = gpro / np.sum(gpro)
+    gpro = gauss_kernel(float(hwhm), float(dw))
+    nhalf = len(gpro) // 2
 
     # Pad spectrum ends to minimize impact of Fourier ringing.
     npad = nhalf + 2  # pad pixels on each end
     spad = np.concatenate((np.full(npad, y[0]), y, np.full(npad, y[-1])))
 
     # Convolve and trim.
-    sout = np.convolve(spad, gpro)  # convolve with gaussian
+    method = "direct" if force_direct else "auto"
+    sout = scipy.signal.convolve(spad, gpro, method=method)  # convolve with gaussian
     sout = sout[npad : npad + nw]  # trim to original data / length
     return sout  # return broadened spectrum.
 
@@ -587,12 +699,20 @@ def polyfit1d(x, y, degree=1, regularization=0):
     idx = np.arange(degree + 1)
     coeff = np.zeros(degree + 1)
 
-    A = np.array([np.power(x, i) for i in idx], dtype=float).T
+    # Vandermonde matrix 1, x, x**2, ..., built by repeated multiplication
+    A = np.vander(np.asarray(x, dtype=float), degree + 1, increasing=True)
     b = y.ravel()
 
-    L = np.array([regularization * i**2 for i in idx])
-    I = np.linalg.inv(A.T @ A + np.diag(L))
-    coeff = I @ A.T @ b
+    # Solve the regularized normal equations with a Cholesky decomposition
+    # instead of inverting the (symmetric, positive definite) matrix
+    M = A.T @ A
+    M[np.diag_indices_from(M)] += regularization * idx ** 2
+    rhs = A.T @ b
+    try:
+        coeff = solve(M, rhs, assume_a="pos")
+    except LinAlgError:
+        # Rank deficient, e.g. fewer distinct x values than degree + 1
+        coeff, *_ = np.linalg.lstsq(M, rhs, rcond=None)
 
     coeff = coeff[::-1]
 
@@ -647,14 +767,17 @@ def polyfit2d(x, y, z, degree=1, max_degree=None, scale=True, plot=False):
     else:
         norm_x = norm_y = 1
 
-    # Calculate elements 1, x, y, x*y, x**2, y**2, ...
-    A = np.array([np.power(x, i) * np.power(y, j) for i, j in idx], dtype=float).T
-    b = z.ravel()
-
+    # Drop masked points before building the design matrix
+    xf, yf, b = np.ravel(x), np.ravel(y), np.ravel(z)
     if np.ma.is_masked(z):
-        mask = z.mask
-        b = z.compressed()
-        A = A[~mask, :]
+        good = ~np.ma.getmaskarray(z).ravel()
+        xf, yf, b = xf[good], yf[good], z.compressed()
+
+    # Calculate elements 1, x, y, x*y, x**2, y**2, ...
+    # from the powers of x and y, which are only calculated once each
+    vx = np.vander(np.asarray(xf, dtype=float), degree + 1, increasing=True)
+    vy = np.vander(np.asarray(yf, dtype=float), degree + 1, increasing=True)
+    A = vx[:, idx[:, 0]] * vy[:, idx[:, 1]]
 
     # Do least squares fit
     C, *_ = lstsq(A, b)
@@ -737,9 +860,9 @@ def polyfit2d_2(x, y, z, degree=1, x0=None, loss="linear", method="lm", plot=Fal
     return coef
 
 
-def bezier_interp(x_old, y_old, x_new):
+def bezier_spline(x_old, y_old):
     """
-    Bezier interpolation, based on the scipy methods
+    Build the interpolating spline used by bezier_interp
 
     This mostly sanitizes the input by removing masked values and duplicate entries
     Note that in case of duplicate entries (in x_old) the results are not well defined as only one of the entries is used and the other is discarded
@@ -748,30 +871,54 @@ def bezier_interp(x_old, y_old, x_new):
     ----------
     x_old : array[n]
         old x values
-    y_old : array[n]
+    y_old : array[n] or array[k, n]
         old y values
-    x_new : array[m]
-        new x values
 
     Returns
     -------
-    y_new : array[m]
-        new y values
+    spline : scipy.interpolate.BSpline
+        spline, that can be evaluated at new x values
     """
 
     # Handle masked arrays
     if np.ma.is_masked(x_old):
-        x_old = np.ma.compressed(x_old)
-        y_old = np.ma.compressed(y_old)
+        mask = np.ma.getmaskarray(x_old)
+        x_old = np.ma.getdata(x_old)[~mask]
+        y_old = np.ma.getdata(y_old)[..., ~mask]
 
     # avoid duplicate entries in x
-    assert x_old.size == y_old.size
+    y_old = np.asarray(y_old)
+    assert x_old.size == y_old.shape[-1]
     x_old, index = np.unique(x_old, return_index=True)
-    y_old = y_old[index]
+    y_old = y_old[..., index]
+
+    # The knots of the interpolating spline only depend on x
+    # so all datasets share them, and are solved for together
+    return scipy.interpolate.make_interp_spline(x_old, y_old, k=3, axis=-1)
+
+
+def bezier_interp(x_old, y_old, x_new):
+    """
+    Bezier interpolation, based on the scipy methods
+
+    Several datasets on the same x values can be interpolated at once,
+    by passing them as rows of a 2D y_old
 
-    knots, coef, order = scipy.interpolate.splrep(x_old, y_old)
-    y_new = scipy.interpolate.BSpline(knots, coef, order)(x_new)
-    return y_new
+    Parameters
+    ----------
+    x_old : array[n]
+        old x values
+    y_old : array[n] or array[k, n]
+        old y values
+    x_new : array[m]
+        new x values
+
+    Returns
+    -------
+    y_new : array[m] or array[k, m]
+        new y values
+    """
+    return bezier_spline(x_old, y_old)(x_new)
 
 
 def safe_interpolation(x_old, y_old, x_new=None, fill_value=0):
@@ -816,16 +963,22 @@ def safe_interpolation(x_old, y_old, x_new=None, fill_value=0):
     x_old, index = np.unique(x_old, return_index=True)
     y_old = y_old[index]
 
-    try:
-        interpolator = scipy.interpolate.interp1d(
-            x_old,
-            y_old,
-            kind="cubic",
-            fill_value=fill_value,
-            bounds_error=False,
-            assume_sorted=True,
-        )
-    except ValueError:
+    # A cubic spline needs at least 4 points, so don't even try with less
+    interpolator = None
+    if x_old.size >= 4:
+        try:
+            interpolator = scipy.interpolate.interp1d(
+                x_old,
+                y_old,
+                kind="cubic",
+                fill_value=fill_value,
+                bounds_error=False,
+                assume_sorted=True,
+            )
+        except ValueError:
+            pass
+
+    if interpolator is None:
         logging.warning(
             "Could not instantiate cubic spline interpolation, using linear instead"
         )
@@ -844,6 +997,42 @@ def safe_interpolation(x_old, y_old, x_new=None, fill_value=0):
         return interpolator
 
 
+def clip_step(lower, ff, upper, ff_old, weight):
+    """
+    One update step of the envelope fits in bottom, middle, and top,
+    i.e. np.clip(lower, ff, upper), and the largest weighted change
+    compared to the previous iteration
+
+    The result is written into lower, to avoid temporary arrays
+
+    Parameters
+    ----------
+    lower : array(float)
+        lower limit of the new values, will be overwritten
+    ff : array(float)
+        current values
+    upper : array(float)
+        upper limit of the new values
+    ff_old : array(float)
+        values of the previous iteration
+    weight : array(float), float
+        weight of each point
+
+    Returns
+    -------
+    ff : array(float)
+        new values
+    dev2 : float
+        largest weighted change, to check for convergence
+    """
+    ff = np.maximum(lower, ff, out=lower)
+    np.minimum(ff, upper, out=ff)
+    change = np.subtract(ff, ff_old)
+    np.abs(change, out=change)
+    change *= weight
+    return ff, np.max(change)
+
+
 def bottom(f, order=1, iterations=40, eps=0.001, poly=False, weight=1, **kwargs):
     """
     bottom tries to fit a smooth curve to the lower envelope
@@ -896,6 +1085,8 @@ def bottom(f, order=1, iterations=40, eps=0.001, poly=False, weight=1, **kwargs)
         fff = (fff - fmin) / (fmax - fmin)
         ff = (f - fmin) / (fmax - fmin) / fff
         ff_old = np.copy(ff)
+        # The filter matrix is the same in every iteration
+        smooth = opt_filter_solver(len(f), order, weight=weight, lambda2=lambda2)
 
     for _ in range(iterations):
         if poly:
@@ -912,19 +1103,10 @@ def bottom(f, order=1, iterations=40, eps=0.001, poly=False, weight=1, **kwargs)
                 dev = np.nan_to_num(t)
                 dev = np.sqrt(t)
         else:
-            t = median_filter(opt_filter(ff, order, weight=weight, lambda2=lambda2), 3)
-            dev = np.sqrt(
-                opt_filter(
-                    np.clip(weight * (t - ff), 0, None),
-                    order,
-                    weight=weight,
-                    lambda2=lambda2,
-                )
-            )
-        ff = np.clip(
-            np.clip(t - dev, ff, None), None, t
-        )  # the order matters, t dominates
-        dev2 = np.max(weight * np.abs(ff - ff_old))
+            t = median_filter(smooth(ff), 3)
+            dev = np.sqrt(smooth(np.clip(weight * (t - ff), 0, None)))
+        # the order matters, t dominates
+        ff, dev2 = clip_step(t - dev, ff, t, ff_old, weight)
         ff_old = ff
         if dev2 <= eps:
             break
@@ -994,7 +1176,8 @@ def middle(
     if poly:
         j = (f >= mn) & (f <= mx)
         n = np.count_nonzero(j)
-        if n <= round(param):
+        param = round(param)
+        if n <= param:
             return f
 
         fmin = np.min(f[j]) - 1
@@ -1007,10 +1190,11 @@ def middle(
         ff = (f - fmin) / (fmax - fmin)
         ff_old = ff
         n = len(f)
+        # The filter matrix is the same in every iteration
+        smooth = opt_filter_solver(n, param, weight=weight, lambda2=lambda2)
 
     for _ in range(iterations):
         if poly:
-            param = round(param)
             if param > 0:
                 t = median_filter(np.polyval(np.polyfit(xx, ff, param), xx), 3)
                 tmp = np.polyval(np.polyfit(xx, (t - ff) ** 2, param), xx)
@@ -1018,14 +1202,11 @@ def middle(
                 t = np.tile(np.polyfit(xx, ff, param), len(f))
                 tmp = np.tile(np.polyfit(xx, (t - ff) ** 2, param), len(f))
         else:
-            t = median_filter(opt_filter(ff, param, weight=weight, lambda2=lambda2), 3)
-            tmp = opt_filter(
-                weight * (t - ff) ** 2, param, weight=weight, lambda2=lambda2
-            )
+            t = median_filter(smooth(ff), 3)
+            tmp = smooth(weight * (t - ff) ** 2)
 
         dev = np.sqrt(np.clip(tmp, 0, None))
-        ff = np.clip(t - dev, ff, t + dev)
-        dev2 = np.max(weight * np.abs(ff - ff_old))
+        ff, dev2 = clip_step(t - dev, ff, t + dev, ff_old, weight)
         ff_old = ff
 
         # print(dev2)
@@ -1091,7 +1272,8 @@ def top(
 
     if poly:
         j = (f >= mn) & (f <= mx)
-        if np.count_nonzero(j) <= round(order):
+        order = round(order)
+        if np.count_nonzero(j) <= order:
             raise ValueError("Not enough points")
         fmin = np.min(f[j]) - 1
         fmax = np.max(f[j]) + 1
@@ -1106,25 +1288,21 @@ def top(
         fff = (fff - fmin) / (fmax - fmin)
         ff = (f - fmin) / (fmax - fmin) / fff
         ff_old = ff
+        # The filter matrix is the same in every iteration
+        order = round(order)
+        smooth = opt_filter_solver(f.size, order, weight=weight, lambda2=lambda2)
 
     for _ in range(iterations):
-        order = round(order)
         if poly:
             t = median_filter(np.polyval(np.polyfit(xx, ff, order), xx), 3)
             tmp = np.polyval(np.polyfit(xx, np.clip(ff - t, 0, None) ** 2, order), xx)
             dev = np.sqrt(np.clip(tmp, 0, None))
         else:
-            t = median_filter(opt_filter(ff, order, weight=weight, lambda2=lambda2), 3)
-            tmp = opt_filter(
-                np.clip(weight * (ff - t), 0, None),
-                order,
-                weight=weight,
-                lambda2=lambda2,
-            )
+            t = median_filter(smooth(ff), 3)
+            tmp = smooth(np.clip(weight * (ff - t), 0, None))
             dev = np.sqrt(np.clip(tmp, 0, None))
 
-        ff = np.clip(t - eps, ff, t + dev * 3)
-        dev2 = np.max(weight * np.abs(ff - ff_old))
+        ff, dev2 = clip_step(t - eps, ff, t + dev * 3, ff_old, weight)
         ff_old = ff
         if dev2 <= eps:
             break
@@ -1136,6 +1314,76 @@ def top(
         return t * fff * (fmax - fmin) + fmin
 
 
+def opt_filter_solver(n, par, weight=None, lambda2=-1):
+    """
+    Prepare the 1D optimal filter for a fixed size, width and weights.
+    The banded filter matrix is only factorized once, so that
+    repeated filtering only needs to solve the triangular systems.
+
+    Parameters
+    ----------
+    n : int
+        size of the data
+    par : float
+        filter width
+    weight : array(float), float, optional
+        weights of each point, between 0 and 1 (default: 1)
+    lambda2 : float, optional
+        constraint on 2nd derivative, only used if positive (default: -1)
+
+    Returns
+    -------
+    solve : Callable
+        function that returns the filtered version of an array of size n
+    """
+    if par < 1:
+        par = 1
+
+    if weight is None:
+        weight = np.ones(n)
+    elif np.isscalar(weight):
+        weight = np.full(n, weight)
+    else:
+        weight = weight[:n]
+
+    if lambda2 > 0:
+        # Apply regularization lambda
+        aij = np.zeros((5, n))
+        # 2nd upper subdiagonal
+        aij[0, 2:] = lambda2
+        # Upper subdiagonal
+        aij[1, 1] = -par - 2 * lambda2
+        aij[1, 2:-1] = -par - 4 * lambda2
+        aij[1, -1] = -par - 2 * lambda2
+        # Main diagonal
+        aij[2, 0] = weight[0] + par + lambda2
+        aij[2, 1] = weight[1] + 2 * par + 5 * lambda2
+        aij[2, 2:-2] = weight[2:-2] + 2 * par + 6 * lambda2
+        aij[2, -2] = weight[-2] + 2 * par + 5 * lambda2
+        aij[2, -1] = weight[-1] + par + lambda2
+        # Lower subdiagonal
+        aij[3, 0] = -par - 2 * lambda2
+        aij[3, 1:-2] = -par - 4 * lambda2
+        aij[3, -2] = -par - 2 * lambda2
+        # 2nd lower subdiagonal
+        aij[4, 0:-2] = lambda2
+        l_and_u = (2, 2)
+    else:
+        a = np.full(n, -abs(par))
+        b = np.copy(weight) + abs(par)
+        b[1:-1] += abs(par)
+        aij = np.array([a, b, a])
+        l_and_u = (1, 1)
+
+    # The matrix is symmetric and (usually) positive definite,
+    # so we can use the cholesky decomposition of the upper half
+    try:
+        cholesky = cholesky_banded(aij[: l_and_u[1] + 1])
+    except LinAlgError:
+        return lambda y: solve_banded(l_and_u, aij, weight * y)
+    return lambda y: cho_solve_banded((cholesky, False), weight * y)
+
+
 def opt_filter(y, par, par1=None, weight=None, lambda2=-1, maxiter=100):
     """
     Optimal filtering of 1D and 2D arrays.
@@ -1169,49 +1417,7 @@ def opt_filter(y, par, par1=None, weight=None, lambda2=-1, maxiter=100):
         if par < 0:
             return y
         y = y.ravel()
-        n = y.size
-
-        if weight is None:
-            weight = np.ones(n)
-        elif np.isscalar(weight):
-            weight = np.full(n, weight)
-        else:
-            weight = weight[:n]
-
-        if lambda2 > 0:
-            # Apply regularization lambda
-            aij = np.zeros((5, n))
-            # 2nd lower subdiagonal
-            aij[0, 2:] = lambda2
-            # Lower subdiagonal
-            aij[1, 1] = -par - 2 * lambda2
-            aij[1, 2:-1] = -par - 4 * lambda2
-            aij[1, -1] = -par - 2 * lambda2
-            # Main diagonal
-            aij[2, 0] = weight[0] + par + lambda2
-            aij[2, 1] = weight[1] + 2 * par + 5 * lambda2
-            aij[2, 2:-2] = weight[2:-2] + 2 * par + 6 * lambda2
-            aij[2, -2] = weight[-2] + 2 * par + 5 * lambda2
-            aij[2, -1] = weight[-1] + par + lambda2
-            # Upper subdiagonal
-            aij[3, 0] = -par - 2 * lambda2
-            aij[3, 1:-2] = -par - 4 * lambda2
-            aij[3, -2] = -par - 2 * lambda2
-            # 2nd lower subdiagonal
-            aij[4, 0:-2] = lambda2
-            # RHS
-            b = weight * y
-
-            f = solve_banded((2, 2), aij, b)
-        else:
-            a = np.full(n, -abs(par))
-            b = np.copy(weight) + abs(par)
-            b[1:-1] += abs(par)
-            aba = np.array([a, b, a])
-
-            f = solve_banded((1, 1), aba, weight * y)
-
-        return f
+        return opt_filter_solver(y.size, par, weight=weight, lambda2=lambda2)(y)
     else:
         # 2D case
         if par1 is None:
@@ -1288,19 +1494,23 @@ def helcorr(obs_long, obs_lat, obs_alt, ra2000, dec2000, jd, system="barycentric
     calculates heliocentric Julian date, barycentric and heliocentric radial
     velocity corrections, using astropy functions
 
+    All parameters may also be arrays of the same shape, to calculate the
+    corrections for several observations in one call, which is much faster
+    than calling this function for each of them
+
     Parameters
     ---------
-    obs_long : float
+    obs_long : float, array
         Longitude of observatory (degrees, western direction is positive)
-    obs_lat : float
+    obs_lat : float, array
         Latitude of observatory (degrees)
-    obs_alt : float
+    obs_alt : float, array
         Altitude of observatory (meters)
-    ra2000 : float
+    ra2000 : float, array
         Right ascension of object for epoch 2000.0 (hours)
-    dec2000 : float
+    dec2000 : float, array
         Declination of object for epoch 2000.0 (degrees)
-    jd : float
+    jd : float, array
         Julian date for the middle of exposure
     system : {"barycentric", "heliocentric"}, optional
         reference system of the result, barycentric: around earth-sun gravity center,
@@ -1308,10 +1518,12 @@ def helcorr(obs_long, obs_lat, obs_alt, ra2000, dec2000, jd, system="barycentric
 
     Returns
     -------
-    correction : float
-        radial velocity correction due to barycentre offset
-    hjd : float
-        Heliocentric Julian date for middle of exposure
+    correction : float, array
+        radial velocity correction due to barycentre offset,
+        one value per observation for array input
+    hjd : float, array
+        Heliocentric Julian date for middle of exposure,
+        one value per observation for array input
     """
 
     jd = 2400000. + jd
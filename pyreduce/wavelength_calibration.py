@@ -593,10 +593,13 @@ class WavelengthCalibration:
             return self.evaluate_step_solution(pos, order, solution)
 
         if self.mode == "1D":
-            result = np.zeros(pos.shape)
-            for i in np.unique(order):
-                select = order == i
-                result[select] = np.polyval(solution[i], pos[select])
+            # Evaluate all points at once with Horner's scheme, like np.polyval,
+            # instead of selecting the points of each order separately
+            coef = np.asarray(solution)[order]
+            result = np.zeros(np.shape(pos))
+            for i in range(coef.shape[-1]):
+                result *= pos
+                result += coef[..., i]
         elif self.mode == "2D":
             result = np.polynomial.polynomial.polyval2d(pos, order, solution)
         else:
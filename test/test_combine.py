@@ -52,6 +52,16 @@ def test_running_mean():
     assert np.array_equal(result, compare)
 
 
+def test_running_sum():
+    arr = np.array([np.arange(10), np.arange(1, 11), np.arange(2, 12)])
+    size = 3
+
+    result = combine_frames.running_sum(arr, size)
+    compare = np.array([np.arange(1, 9), np.arange(2, 10), np.arange(3, 11)]) * size
+
+    assert np.allclose(result, compare)
+
+
 def test_combine_frames(files):
     img = np.full((100, 100), 10)
     ovscx = 5
@@ -78,3 +88,113 @@ def test_combine_frames(files):
 
     assert chead["exptime"] == 10 * len(files)
 
+
+def test_combine_frames_two_files(files):
+    files = files[:2]
+    for f, value, exptime in zip(files, [10, 20], [10, 15]):
+        head = fits.Header(
+            cards={
+                "ESO DET OUT1 PRSCX": 0,
+                "ESO DET OUT1 OVSCX": 5,
+                "ESO DET OUT1 CONAD": 1,
+                "ESO DET OUT1 RON": 0,
+                "EXPTIME": exptime,
+                "RA": 100,
+                "DEC": 51,
+                "MJD-OBS": 12030,
+            }
+        )
+        fits.writeto(f, data=np.full((100, 100), value), header=head)
+
+    combine, chead = combine_frames.combine_frames(files, "UVES", "middle", 0)
+
+    # Previously the first file was used twice, giving 2 * 10 and 2 * 10 s
+    assert np.all(combine == 10 + 20)
+    assert chead["exptime"] == 10 + 15
+
+
+def amplifier_header(orientation, rows, ncol, gains, readnoises):
+    # One amplifier for each row range, covering all columns
+    cards = {"EXPTIME": 10, "E_AMPL": len(rows), "E_ORIENT": orientation}
+    cards["E_LINEAR"] = True
+    for i, ((ylo, yhi), gain, readnoise) in enumerate(zip(rows, gains, readnoises)):
+        cards.update({f"E_XLO{i + 1}": 0, f"E_XHI{i + 1}": ncol})
+        cards.update({f"E_YLO{i + 1}": ylo, f"E_YHI{i + 1}": yhi})
+        cards.update({f"E_GAIN{i + 1}": gain, f"E_READN{i + 1}": readnoise})
+    return fits.Header(cards)
+
+
+@pytest.mark.parametrize("orientation", [0, 1])
+def test_combine_frames_amplifiers(files, orientation, tmp_path, monkeypatch):
+    # Two amplifiers, each covering half of the rows of the image
+    shape = (60, 40)
+    rows, gains, readnoises = [(0, 30), (30, 60)], [1.0, 2.0], [1.0, 3.0]
+    head = amplifier_header(orientation, rows, shape[1], gains, readnoises)
+    images = np.random.normal(100, 10, size=(len(files), *shape)).astype(np.float32)
+    images[0, 20, 10] += 1000  # a cosmic ray
+    for f, data in zip(files, images):
+        fits.writeto(f, data=data, header=head, overwrite=True)
+
+    # The instrument and clipnflip are not part of what we are testing here
+    load = lambda fname, *args, **kwargs: fits.getheader(fname)
+    monkeypatch.setattr(combine_frames, "load_fits", load)
+    monkeypatch.setattr(combine_frames, "clipnflip", lambda image, header: image)
+
+    # Split each amplifier into several row blocks
+    monkeypatch.setattr(combine_frames, "ROW_BLOCK_SIZE", 8)
+    combine, chead = combine_frames.combine_frames(files, None, None, 0, window=5)
+    assert chead["nimages"] == len(files)
+    assert chead["npixfix"] > 0
+
+    # Reference: each amplifier section on its own, as a single block
+    monkeypatch.setattr(combine_frames, "ROW_BLOCK_SIZE", shape[0])
+    for (ylo, yhi), gain, readnoise in zip(rows, gains, readnoises):
+        head = amplifier_header(
+            orientation, [(0, yhi - ylo)], shape[1], [gain], [readnoise]
+        )
+        section = [str(tmp_path / f"section_{ylo}_{i}.fits") for i in range(len(files))]
+        for f, data in zip(section, images):
+            fits.writeto(f, data=data[ylo:yhi], header=head)
+        expected, _ = combine_frames.combine_frames(section, None, None, 0, window=5)
+        assert np.array_equal(combine[ylo:yhi], expected)
+
+
+def write_scaled(fname, data, bscale=2, bzero=1000):
+    # Store the data as int16, with the scaling in BSCALE and BZERO
+    hdu = fits.PrimaryHDU(data.astype(float))
+    hdu.scale("int16", bscale=bscale, bzero=bzero)
+    hdu.writeto(fname, overwrite=True)
+
+
+def test_combine_amplifier_scaled(files, monkeypatch):
+    # The image is split into row blocks, which do not divide it evenly
+    monkeypatch.setattr(combine_frames, "ROW_BLOCK_SIZE", 16)
+    shape = (40, 30)
+    image = 1000 + 2 * np.random.randint(0, 500, size=shape)
+    for f in files:
+        write_scaled(f, image)
+
+    bscale = [fits.getheader(f)["BSCALE"] for f in files]
+    bzero = [fits.getheader(f)["BZERO"] for f in files]
+    idx = (slice(None), slice(None))
+    args = (files, 0, idx, np.asarray, bscale, bzero, 5, 1, 1, 3.5)
+    combined, n_bad = combine_frames.combine_amplifier(*args)
+
+    # Identical frames have no outliers, so the result is just their sum
+    expected = sum(fits.getdata(f) for f in files)
+    assert n_bad == 0
+    assert np.allclose(combined, expected)
+
+    # With noise and a cosmic ray, the blocks give the same result as a single block
+    for i, f in enumerate(files):
+        noisy = image + 2 * np.random.randint(0, 10, size=shape)
+        if i == 0:
+            noisy[16, 10] += 2000
+        write_scaled(f, noisy)
+    blocks, n_bad = combine_frames.combine_amplifier(*args)
+    assert n_bad > 0
+
+    monkeypatch.setattr(combine_frames, "ROW_BLOCK_SIZE", shape[0])
+    single, n_bad_single = combine_frames.combine_amplifier(*args)
+    assert np.array_equal(blocks, single)
+    assert n_bad == n_bad_single
@@ -1,3 +1,5 @@
+import warnings
+
 import pytest
 import numpy as np
 
@@ -34,3 +36,39 @@ def test_continuum(spec, wave, normflat, order_range):
         == norm.shape[1]
     )
 
+
+def make_orders(nord=3, ncol=100):
+    # Neighbouring orders overlap by 10 points
+    x = np.arange(ncol)
+    wave = np.array([5000 + 90 * i + x for i in range(nord)], dtype=float)
+    cont = 1000 * np.exp(-(((x - ncol / 2) / ncol) ** 2)) * np.ones((nord, 1))
+    spec = cont * np.arange(1, nord + 1)[:, None]
+    sigm = np.sqrt(spec)
+    return spec, wave, cont, sigm
+
+
+def test_splice_orders():
+    spec, wave, cont, sigm = make_orders()
+    spec, wave, cont, sigm = splice_orders(spec, wave, cont, sigm, scaling=True)
+
+    # Each order is scaled to spec / cont = 1
+    assert not np.any(np.ma.getmaskarray(spec))
+    assert np.allclose(spec / cont, 1, rtol=1e-4)
+    assert np.all(np.isfinite(sigm))
+
+
+def test_splice_orders_masked_order():
+    spec, wave, cont, sigm = make_orders()
+    spec = np.ma.masked_array(spec)
+    spec[1] = np.ma.masked
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        spec, wave, cont, sigm = splice_orders(spec, wave, cont, sigm, scaling=True)
+
+    # The masked order does not affect the others
+    assert np.all(np.ma.getmaskarray(spec[1]))
+    assert np.all(np.isfinite(cont[1].data))
+    for i in [0, 2]:
+        assert not np.any(np.ma.getmaskarray(spec[i]))
+        assert np.allclose(spec[i] / cont[i], 1, rtol=1e-4)
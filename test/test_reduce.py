@@ -1,4 +1,9 @@
+import os
+
+import joblib
+import numpy as np
 import pytest
+from astropy.io import fits
 
 from pyreduce import reduce
 
@@ -25,3 +30,127 @@ def test_configuration():
 
 def test_main():
     reduce.main(steps=())
+
+
+def test_cache_key(tmp_path):
+    fname = tmp_path / "bias.fits"
+    fname.write_bytes(b"\0" * 10)
+    files = {"bias": [str(fname)]}
+    config = reduce.load_config(None, "UVES", 0)
+    config["reduce"]["use_cache"] = True
+
+    reducer = reduce.Reducer(
+        files, str(tmp_path), "target", "UVES", "middle", "night", config
+    )
+    module = reducer.modules["bias"](*reducer.inputs, **config["bias"])
+    # Without the key of the mask, the bias can not be verified
+    assert reducer.cache_key("bias", module) is None
+    reducer.verified_key("mask")
+    key = reducer.cache_key("bias", module)
+    assert reducer.read_key("bias", module) is None
+
+    reducer.write_key("bias", module, key)
+    assert reducer.read_key("bias", module) == key
+    assert reducer.cache_key("bias", module) == key
+
+    # Changing the input files or the settings invalidates the key
+    fname.write_bytes(b"\0" * 20)
+    assert reducer.cache_key("bias", module) != key
+    key = reducer.cache_key("bias", module)
+    config["bias"]["plot"] = not config["bias"]["plot"]
+    assert reducer.cache_key("bias", module) != key
+
+    # So does a new bad pixel mask
+    mask_file = tmp_path / "mask_uves_middle.fits.gz"
+    mask_file.write_bytes(b"\0" * 10)
+    config["mask"]["directory"] = str(tmp_path)
+    key = reducer.cache_key("bias", module)
+    os.utime(mask_file, (0, 0))
+    assert reducer.cache_key("bias", module) != key
+
+
+def test_continuum_save_load(tmp_path):
+    config = reduce.load_config(None, "UVES", 0)
+    reducer = reduce.Reducer(
+        {}, str(tmp_path), "target", "UVES", "middle", "night", config
+    )
+    module = reducer.modules["continuum"](*reducer.inputs, **config["continuum"])
+
+    heads = [fits.Header({"OBJECT": "star", "E_JD": 1.5}), fits.Header()]
+    mask = np.zeros((2, 5), dtype=bool)
+    mask[1, :2] = True
+    specs = [np.ma.masked_array(np.random.rand(2, 5), mask=mask) for _ in heads]
+    sigmas = [np.ma.masked_array(np.random.rand(2, 5), mask=mask) for _ in heads]
+    conts = [np.ma.masked_array(np.random.rand(2, 5), mask=mask) for _ in heads]
+    columns = [np.array([[0, 5], [2, 5]]) for _ in heads]
+
+    module.save(heads, specs, sigmas, conts, columns)
+    result = module.load()
+
+    assert result[0][0]["OBJECT"] == "star"
+    assert result[0][0]["E_JD"] == 1.5
+    assert len(result[0][1]) == 0
+    for saved, loaded in zip((specs, sigmas, conts), result[1:4]):
+        assert len(loaded) == len(saved)
+        for a, b in zip(saved, loaded):
+            assert np.array_equal(np.ma.getmaskarray(b), mask)
+            assert np.allclose(b.compressed(), a.compressed().astype(np.float32))
+    assert np.array_equal(result[4], columns)
+
+    # A file in an old or unknown format is treated as missing
+    with open(module.savefile, "wb") as f:
+        joblib.dump(specs, f)
+    with pytest.raises(FileNotFoundError):
+        module.load()
+
+
+class CountingStep(reduce.Step):
+    """Step that saves its config value, and counts how often it is run"""
+
+    runs = 0
+
+    def __init__(self, *args, **config):
+        super().__init__(*args, **config)
+        self._dependsOn += config.get("depends", [])
+        self.value = config.get("value")
+
+    @property
+    def savefile(self):
+        return os.path.join(self.output_dir, self.prefix + f".{self.value}.npy")
+
+    def run(self, **kwargs):
+        CountingStep.runs += 1
+        np.save(self.savefile, self.value)
+        return self.value
+
+    def load(self, **kwargs):
+        return np.load(self.savefile)
+
+
+def test_cache_invalidation(tmp_path):
+    config = reduce.load_config(None, "UVES", 0)
+    config["first"] = {"value": 1, "depends": ["mask"]}
+    config["second"] = {"value": 2, "depends": ["first"]}
+
+    def run(step, use_cache=True):
+        config["reduce"]["use_cache"] = use_cache
+        reducer = reduce.Reducer(
+            {}, str(tmp_path), "target", "UVES", "middle", "night", config
+        )
+        reducer.modules = dict(reducer.modules, first=CountingStep, second=CountingStep)
+        runs = CountingStep.runs
+        reducer.run_module(step)
+        return CountingStep.runs - runs
+
+    assert run("first") == 1
+    assert run("second") == 1
+    # Nothing changed, the dependency is loaded and its key verified
+    assert run("second") == 0
+
+    # Running without cache removes the key, so the results of the
+    # dependency can not be verified anymore and the step runs again
+    assert run("first", use_cache=False) == 1
+    assert run("second") == 1
+    assert run("first") == 1
+    assert run("second") == 1
+    assert run("second") == 0
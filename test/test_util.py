@@ -0,0 +1,105 @@
+import os
+
+import pytest
+import numpy as np
+from astropy.io import fits
+
+from pyreduce import util
+
+
+@pytest.mark.parametrize("lambda2", [-1, 100])
+def test_opt_filter_solver(lambda2):
+    n, par = 200, 10.0
+    y = np.sin(np.linspace(0, 10, n)) + np.random.normal(0, 0.1, n)
+    weight = np.random.uniform(0.1, 1, n)
+
+    # The filter solves (W + par * D1.T D1 + lambda2 * D2.T D2) x = W y
+    # with the first (D1) and second (D2) difference matrices
+    d1 = np.diff(np.eye(n), axis=0)
+    d2 = np.diff(np.eye(n), 2, axis=0)
+    matrix = np.diag(weight) + par * d1.T @ d1
+    if lambda2 > 0:
+        matrix += lambda2 * d2.T @ d2
+    expected = np.linalg.solve(matrix, weight * y)
+
+    smooth = util.opt_filter_solver(n, par, weight=weight, lambda2=lambda2)
+    assert np.allclose(smooth(y), expected)
+    # The factorization can be reused for other data of the same size
+    assert np.allclose(smooth(2 * y), 2 * expected)
+
+    result = util.opt_filter(y, par, weight=weight, lambda2=lambda2)
+    assert np.allclose(result, expected)
+
+
+def test_helcorr_arrays():
+    # Two observations from Paranal and one from La Palma
+    obs_long = np.array([-70.4, -70.4, 17.9])
+    obs_lat = np.array([-24.6, -24.6, 28.8])
+    obs_alt = np.array([2635.0, 2635.0, 2396.0])
+    ra = np.array([15.0, 3.2, 22.1])
+    dec = np.array([-20.0, 45.0, 5.0])
+    jd = np.array([58000.1, 58100.3, 58200.7])
+
+    corrections, hjds = util.helcorr(obs_long, obs_lat, obs_alt, ra, dec, jd)
+    assert corrections.shape == hjds.shape == (3,)
+
+    for i in range(3):
+        correction, hjd = util.helcorr(
+            obs_long[i], obs_lat[i], obs_alt[i], ra[i], dec[i], jd[i]
+        )
+        assert np.isclose(corrections[i], correction)
+        assert np.isclose(hjds[i], hjd)
+
+
+def test_find_first_index():
+    assert util.find_first_index(["red", "middle", "blue"], "blue") == 2
+    assert util.find_first_index(np.array([3, 1, 4, 1]), 1) == 1
+    for arr in [[], ["red"], np.array([]), np.array([3, 1])]:
+        with pytest.raises(Exception):
+            util.find_first_index(arr, 5)
+
+
+def test_load_header_cache(tmp_path):
+    fname = str(tmp_path / "header.fits")
+    cards = {"EXPTIME": 10, "RA": 100, "DEC": 51, "MJD-OBS": 12030}
+    fits.writeto(fname, data=np.zeros((10, 10)), header=fits.Header(cards))
+
+    head = util.load_fits(fname, "UVES", "middle", 0, header_only=True)
+    hits = util.load_header.cache_info().hits
+    # Changes to the returned header do not affect the cache
+    head["EXPTIME"] = 20
+    head = util.load_fits(fname, "UVES", "middle", 0, header_only=True)
+    assert util.load_header.cache_info().hits == hits + 1
+    assert head["EXPTIME"] == 10
+
+    # A modified file is read again
+    cards["EXPTIME"] = 30
+    fits.writeto(fname, np.zeros((10, 10)), fits.Header(cards), overwrite=True)
+    os.utime(fname, (0, 0))
+    head = util.load_fits(fname, "UVES", "middle", 0, header_only=True)
+    assert head["EXPTIME"] == 30
+
+
+def test_polyfit1d():
+    x = np.linspace(-1, 1, 20)
+    y = 1 + 2 * x - 3 * x ** 2
+    assert np.allclose(util.polyfit1d(x, y, degree=2), [-3, 2, 1])
+
+    # Fewer distinct x values than coefficients still give a least squares fit
+    x = np.array([1.0, 1.0, 1.0, 2.0])
+    y = np.array([1.0, 1.0, 1.0, 3.0])
+    coeff = util.polyfit1d(x, y, degree=3)
+    assert np.all(np.isfinite(coeff))
+    assert np.allclose(np.polyval(coeff, x), y)
+
+
+def test_gaussfit_linear():
+    x = np.linspace(-5, 5, 30)
+    y = 3 * np.exp(-((x - 0.5) ** 2) / (2 * 2)) + 1
+    a, mu, sig, offset = util.gaussfit_linear(x, y)
+    assert np.isclose(mu, 0.5, atol=0.1)
+
+    # Only two distinct x values still give a least squares solution
+    x = np.array([0.0, 0.0, 1.0, 1.0])
+    y = np.array([2.0, 2.0, 1.0, 1.0])
+    assert np.all(np.isfinite(util.gaussfit_linear(x, y)[1:]))